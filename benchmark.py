@@ -0,0 +1,387 @@
+# ============ Library benchmark suite ============
+"""Time the library's main operations on synthetic catalogs
+
+    python benchmark.py --books 1000 100000 --users 10000 --output run.json
+    python benchmark.py --books 1000 100000 --users 10000 --compare run.json
+
+Each catalog size is generated from --seed into a temporary directory and
+benchmarked in a fresh process, so load times and peak memory of one size
+do not leak into the next. Results are printed as a table and saved as
+JSON; --compare prints how a run differs from a saved one and flags the
+operations that got slower than --threshold allows.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import shutil
+import subprocess
+
+import library
+from library import Library, UsersAcount, LibraryService, SqliteStorage, Book, LibraryError
+
+# items per call of the bulk operations: a borrower's pick, a returns cart
+BORROW_CART = 10
+RETURN_CART = 50
+
+SYLLABLES = ["ka", "lo", "mi", "ra", "te", "so", "vin", "dar", "el", "mor", "quen", "ash", "bri", "tor", "ul",
+             "fen", "gal", "ith", "ny", "pe", "rod", "sa", "thu", "wy", "zan", "cor", "dun", "es", "hal", "ri"]
+
+
+# ============== Synthetic data =============
+def make_words(rng, count):
+    """count distinct made-up words, so searches hit a realistic spread of books"""
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def generate_dataset(directory, books, users, loans, seed):
+    """Write books.json, acount_info.csv and loans.csv for a catalog of the given size"""
+    rng = random.Random(seed)
+    words = make_words(rng, 5000)
+    names = make_words(rng, 2000)
+    authors = [f"{rng.choice(names).title()} {rng.choice(names).title()}" for _ in range(max(books // 20, 10))]
+
+    copies = []
+    with open(os.path.join(directory, "books.json"), "w", encoding="utf-8") as f:
+        f.write("[\n")
+        for book_id in range(1, books + 1):
+            name = " ".join(rng.choice(words) for _ in range(rng.randint(1, 4))).title()
+            total = rng.randint(1, 5)
+            copies.append(total)
+            book = Book(name, rng.choice(authors), rng.randint(1900, 2024), total, id=book_id)
+            f.write((",\n    " if book_id > 1 else "    ") + json.dumps(book.to_dict(), ensure_ascii=False))
+        f.write("\n]\n")
+
+    with open(os.path.join(directory, "acount_info.csv"), "w", encoding="utf-8") as f:
+        for i in range(users):
+            f.write(f"user{i},password{i},\n")
+
+    # loans are taken out of the available copies, as borrowing would have
+    taken = set()
+    out = {}
+    attempts = 0
+    while len(taken) < min(loans, users * books) and attempts < loans * 10:
+        attempts += 1
+        Username, book_id = f"user{rng.randrange(users)}", rng.randint(1, books)
+        if (Username, book_id) in taken or out.get(book_id, 0) >= copies[book_id - 1]:
+            continue
+        taken.add((Username, book_id))
+        out[book_id] = out.get(book_id, 0) + 1
+    with open(os.path.join(directory, "loans.csv"), "w", encoding="utf-8") as f:
+        for Username, book_id in sorted(taken):
+            f.write(f"{Username},{book_id},{time.time()}\n")
+    if out:
+        # second pass over the file just written to lower the available copies
+        path = os.path.join(directory, "books.json")
+        with open(path, "r", encoding="utf-8") as src, open(path + ".tmp", "w", encoding="utf-8") as dst:
+            for line in src:
+                stripped = line.strip().rstrip(",")
+                if stripped.startswith("{"):
+                    book = json.loads(stripped)
+                    if book["id"] in out:
+                        book["available_copies"] -= out[book["id"]]
+                        book["borrowed"] = book["available_copies"] == 0
+                        line = line.replace(stripped, json.dumps(book, ensure_ascii=False))
+                dst.write(line)
+        os.replace(path + ".tmp", path)
+    return words
+
+
+# ============== Timing =============
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def summarize(latencies, errors=0, items=None):
+    """Throughput and latency percentiles (in ms) of a list of call durations in seconds
+
+    For bulk calls, items is the number of items they handled in all, and
+    ops_per_sec counts items, so it compares with the single-item calls.
+    """
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    items = len(ordered) if items is None else items
+    return {
+        "calls": len(ordered),
+        "items": items,
+        "errors": errors,
+        "seconds": round(total, 6),
+        "ops_per_sec": round(items / total, 1) if total else None,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 4) if ordered else None,
+        "p90_ms": round(percentile(ordered, 0.90) * 1000, 4) if ordered else None,
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 4) if ordered else None,
+        "max_ms": round(ordered[-1] * 1000, 4) if ordered else None,
+    }
+
+
+def time_calls(calls):
+    """Run each zero-argument callable, returns summarize() of their durations"""
+    latencies, errors = [], 0
+    for call in calls:
+        started = time.perf_counter()
+        try:
+            call()
+        except LibraryError:
+            errors += 1
+        latencies.append(time.perf_counter() - started)
+    return summarize(latencies, errors)
+
+
+def time_bulk_calls(calls):
+    """Like time_calls, for callables returning one outcome per item as LibraryService.apply_each does"""
+    latencies, errors, items = [], 0, 0
+    for call in calls:
+        started = time.perf_counter()
+        outcomes = call()
+        latencies.append(time.perf_counter() - started)
+        items += len(outcomes)
+        errors += sum(isinstance(outcome, LibraryError) for outcome in outcomes)
+    return summarize(latencies, errors, items)
+
+
+# ============== Benchmarks =============
+def open_library(directory, storage):
+    """A Library and UsersAcount on the files in directory, loaded like library.py does"""
+    sqlite = SqliteStorage(os.path.join(directory, "library.db")) if storage == "sqlite" else None
+    books = Library(os.path.join(directory, "books.json"), os.path.join(directory, "books.txt"),
+                    journal=storage == "journal", storage=sqlite)
+    users = UsersAcount(os.path.join(directory, "acount_info.csv"), journal=storage == "journal", storage=sqlite)
+    return books, users
+
+
+def run_size(directory, storage, books, ops, write_ops, repeat, seed, words):
+    """Benchmark one generated catalog, returns {operation: summary}"""
+    rng = random.Random(seed + 1)
+    results = {}
+
+    if storage == "sqlite":
+        # the first open copies the json/csv files into the database; not what is measured
+        started = time.perf_counter()
+        open_library(directory, storage)
+        results["sqlite_import"] = summarize([time.perf_counter() - started])
+
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        lib, users = open_library(directory, storage)
+        latencies.append(time.perf_counter() - started)
+    results["load_books"] = summarize(latencies)
+    load_peak = library.peak_memory_mb()
+    service = LibraryService(lib, users)
+
+    def load_users():
+        users.users_stamp = None    # as if another process had changed the files
+        users.loadUser()
+    results["loadUser"] = time_calls([load_users] * repeat)
+
+    # keywords: a word, part of a word, two words, an author's surname, and misses
+    keywords = []
+    for _ in range(ops):
+        kind = rng.random()
+        word = rng.choice(words)
+        if kind < 0.4:
+            keywords.append(word)
+        elif kind < 0.6:
+            keywords.append(word[:rng.randint(3, len(word))])
+        elif kind < 0.8:
+            keywords.append(f"{word} {rng.choice(words)}")
+        elif kind < 0.9:
+            keywords.append(lib.books[rng.randrange(len(lib.books))]['author'].split()[-1])
+        else:
+            keywords.append(word + "zzq")
+
+    def uncached(search):
+        def call(keyword):
+            lib.search_cache.clear()
+            search(keyword)
+        return call
+    for name, search in (("search_books", lib.search_books), ("rank_books", lib.rank_books)):
+        call = uncached(search)
+        results[name] = time_calls([lambda keyword=keyword: call(keyword) for keyword in keywords])
+    for keyword in keywords:
+        lib.search_books(keyword)   # fill the cache, the timed pass repeats the same searches
+    results["search_books_cached"] = time_calls(
+        [lambda keyword=keyword: lib.search_books(keyword) for keyword in keywords])
+    if storage != "sqlite":
+        linked_list = lib.book_linked_list
+        results["find_all_books_recursive"] = time_calls(
+            [lambda keyword=keyword: linked_list.find_all_books_recursive(linked_list.head, keyword)
+             for keyword in keywords])
+
+    Usernames = list(users.loadUser())
+    loans = []
+    def borrow(Username, book_id):
+        service.borrow(Username, book_id)
+        loans.append((Username, book_id))
+    results["borrow"] = time_calls(
+        [lambda Username=rng.choice(Usernames), book_id=rng.randint(1, books): borrow(Username, book_id)
+         for _ in range(write_ops)])
+    results["return_book"] = time_calls(
+        [lambda loan=loan: service.return_book(*loan) for loan in list(loans)])
+
+    # the same number of items again, in bulk calls written once each
+    loans.clear()
+    def borrow_many(Username, book_ids):
+        outcomes = service.borrow_many(Username, book_ids)
+        loans.extend((Username, book_id) for book_id, outcome in zip(book_ids, outcomes)
+                     if not isinstance(outcome, LibraryError))
+        return outcomes
+    results["borrow_many"] = time_bulk_calls(
+        [lambda Username=rng.choice(Usernames), book_ids=[rng.randint(1, books) for _ in range(BORROW_CART)]:
+         borrow_many(Username, book_ids)
+         for _ in range(max(write_ops // BORROW_CART, 1))])
+    results["return_many"] = time_bulk_calls(
+        [lambda cart=loans[start:start + RETURN_CART]: service.return_many(cart)
+         for start in range(0, len(loans), RETURN_CART)])
+
+    changes = [(rng.randint(1, books), 1) for _ in range(write_ops)]
+    results["change_copies"] = time_calls(
+        [lambda change=change: service.change_copies(*change) for change in changes])
+    results["change_copies_many"] = time_bulk_calls(
+        [lambda cart=changes[start:start + RETURN_CART]: service.change_copies_many(cart)
+         for start in range(0, len(changes), RETURN_CART)])
+
+    if storage != "sqlite":
+        results["save_books"] = time_calls([lib.save_books] * repeat)
+
+    return results, load_peak
+
+
+def child_main(args):
+    """Run one size in this process and write the results to args.child_output"""
+    words = json.loads(args.child_words)
+    results, load_peak = run_size(args.child_dir, args.storage, args.books[0], args.ops, args.write_ops,
+                                  args.repeat, args.seed, words)
+    with open(args.child_output, "w", encoding="utf-8") as f:
+        json.dump({"operations": results, "load_peak_memory_mb": load_peak,
+                   "peak_memory_mb": library.peak_memory_mb()}, f)
+
+
+def benchmark_size(args, books):
+    """Generate a catalog of books books and benchmark it in a child process"""
+    directory = tempfile.mkdtemp(prefix="library-bench-")
+    try:
+        started = time.perf_counter()
+        users = args.users if args.users is not None else max(books // 10, 10)
+        loans = args.loans if args.loans is not None else users // 2
+        words = generate_dataset(directory, books, users, loans, args.seed)
+        generated = time.perf_counter() - started
+
+        output = os.path.join(directory, "results.json")
+        # a sample of the vocabulary is enough for picking keywords
+        sample = random.Random(args.seed).sample(words, min(len(words), 500))
+        command = [sys.executable, os.path.abspath(__file__), "--books", str(books), "--storage", args.storage,
+                   "--ops", str(args.ops), "--write-ops", str(args.write_ops), "--repeat", str(args.repeat),
+                   "--seed", str(args.seed), "--child-dir", directory, "--child-output", output,
+                   "--child-words", json.dumps(sample)]
+        subprocess.run(command, check=True)
+        with open(output, "r", encoding="utf-8") as f:
+            result = json.load(f)
+        result.update({"books": books, "users": users, "loans": loans, "generate_seconds": round(generated, 3)})
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# ============== Reporting =============
+def print_run(run):
+    for size in run["sizes"]:
+        peak = size["peak_memory_mb"]
+        print(f"\n=== {size['books']} books, {size['users']} users, {size['loans']} loans ({run['storage']}) ===")
+        print(f"peak memory {peak:.0f} MB" if peak is not None else "peak memory unknown")
+        print(f"{'operation':<26}{'calls':>7}{'ops/s':>12}{'p50 ms':>12}{'p90 ms':>12}{'p99 ms':>12}{'max ms':>12}")
+        for name, stats in size["operations"].items():
+            cells = [stats[key] for key in ("ops_per_sec", "p50_ms", "p90_ms", "p99_ms", "max_ms")]
+            print(f"{name:<26}{stats['calls']:>7}" + "".join(
+                f"{cell:>12.3f}" if cell is not None else f"{'-':>12}" for cell in cells))
+
+
+def compare_runs(run, baseline, threshold):
+    """Print p50 latency changes against a saved run, returns the number of regressions"""
+    regressions = 0
+    old_sizes = {size["books"]: size for size in baseline["sizes"]}
+    for size in run["sizes"]:
+        old = old_sizes.get(size["books"])
+        if old is None:
+            continue
+        print(f"\n=== {size['books']} books: p50 latency against {baseline.get('started', 'baseline')} ===")
+        for name, stats in size["operations"].items():
+            before = old["operations"].get(name)
+            if not before or not before["p50_ms"] or stats["p50_ms"] is None:
+                continue
+            change = stats["p50_ms"] / before["p50_ms"] - 1
+            slower = change > threshold
+            regressions += slower
+            print(f"{'❌' if slower else '✅'} {name:<26}{before['p50_ms']:>11.3f} -> {stats['p50_ms']:>11.3f} ms"
+                  f"  ({change:+.0%})")
+    return regressions
+
+
+# ============== main =============
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Library Management System on synthetic data")
+    parser.add_argument("--books", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="catalog sizes to benchmark, e.g. 1000 100000 1000000 (default 1000 10000 100000)")
+    parser.add_argument("--users", type=int, help="number of accounts (default: a tenth of the books)")
+    parser.add_argument("--loans", type=int, help="books already on loan (default: half the users)")
+    parser.add_argument("--storage", choices=["json", "journal", "sqlite"], default="json",
+                        help="storage mode, as library.py's --journal and --sqlite (default json)")
+    parser.add_argument("--ops", type=int, default=500, help="searches per search benchmark (default 500)")
+    parser.add_argument("--write-ops", type=int, default=50,
+                        help="borrows, returns and copy changes per size, singly and again in bulk (default 50)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of load_books, loadUser and save_books (default 3)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated data and operations (default 1)")
+    parser.add_argument("--output", metavar="FILE", help="save the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare with the results saved by an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown of p50 latency that counts as a regression (default 0.2, that is 20%%)")
+    # used by the child processes benchmarking one size each
+    parser.add_argument("--child-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--child-output", help=argparse.SUPPRESS)
+    parser.add_argument("--child-words", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_dir:
+        child_main(args)
+        return
+
+    run = {
+        "started": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "storage": args.storage,
+        "seed": args.seed,
+        "ops": args.ops,
+        "write_ops": args.write_ops,
+        "repeat": args.repeat,
+        "sizes": [],
+    }
+    for books in args.books:
+        print(f"⏱  Benchmarking {books} books...", flush=True)
+        run["sizes"].append(benchmark_size(args, books))
+    print_run(run)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(run, f, indent=2)
+        print(f"\n✅ Results saved to {args.output}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_runs(run, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ {regressions} operation(s) more than {args.threshold:.0%} slower")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
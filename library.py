@@ -1,952 +1,4373 @@
 # ============ imports ============
 import os
+import sys
 import json
+import re
+import argparse
+import atexit
+import time
+import sqlite3
+import stat
+import csv
+import tempfile
+import threading
+import contextlib
+import asyncio
+import base64
+import queue
+import functools
+import concurrent.futures
+import heapq
+import bisect
+import unicodedata
+import socket
+import signal
+import traceback
+from collections import OrderedDict, deque
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs, unquote
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+
+# ============== Book record =============
+class Book:
+    """One book; reads and writes like the books.json dict but without a dict per book"""
+    FIELDS = ("id", "name", "author", "year", "total_copies", "available_copies", "borrowed")
+    __slots__ = FIELDS
+
+    def __init__(self, name, author, year, total_copies, available_copies=None, borrowed=False, id=None):
+        self.id = id
+        self.name = name
+        # many books share an author, keep one copy of the string
+        self.author = sys.intern(author)
+        self.year = year
+        self.total_copies = total_copies
+        self.available_copies = total_copies if available_copies is None else available_copies
+        self.borrowed = borrowed
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['name'], data['author'], data['year'], data['total_copies'],
+                   data.get('available_copies'), data.get('borrowed', False), data.get('id'))
+
+    def to_dict(self):
+        """The book as it is stored in books.json"""
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        if self.id is None:
+            del data['id']
+        return data
+
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        setattr(self, field, sys.intern(value) if field == "author" else value)
+
+    def get(self, field, default=None):
+        return getattr(self, field) if field in self.FIELDS else default
+
+    def update(self, data):
+        for field, value in data.items():
+            self[field] = value
+
+    def __repr__(self):
+        return f"Book({self.to_dict()!r})"
+
+
+class LibraryError(Exception):
+    """An operation the library refused; the message can be shown to the user"""
+
+
+class InvalidInput(LibraryError):
+    """The arguments of a request are not acceptable"""
+
+
+class AuthenticationFailed(LibraryError):
+    """Wrong username or password"""
+
+
+class NotFound(LibraryError):
+    pass
+
+
+class BookNotFound(NotFound):
+    pass
+
+
+class UserNotFound(NotFound):
+    pass
+
+
+class Conflict(LibraryError):
+    """The request is valid but the library's current state does not allow it"""
+
+
+class UsernameTaken(Conflict):
+    pass
+
+
+class AlreadyBorrowed(Conflict):
+    pass
+
+
+class NoCopiesLeft(Conflict):
+    pass
+
+
+class NotBorrowed(Conflict):
+    pass
+
+
+# ============== Metrics =============
+class Metrics:
+    """Counters and latency histograms of the hot paths, exported as Prometheus text or JSON
+
+    Recording takes a lock and a few dict operations, cheap enough to leave
+    on; with enabled False (LIBRARY_METRICS=0 or --no-metrics) nothing is
+    recorded and timed functions only pay one attribute check.
+    """
+    # upper bounds of the latency buckets, in seconds
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}      # (name, labels as a tuple of pairs) -> number
+        self.histograms = {}    # operation -> [calls per bucket..., calls above the last, total seconds]
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def file_io(self, kind, filepath, size):
+        """Count one read or write ("read" or "write") of size bytes of a data file"""
+        if not self.enabled:
+            return
+        name = os.path.basename(filepath)
+        self.count(f"library_file_{kind}s_total", file=name)
+        self.count(f"library_file_{kind}_bytes_total", size, file=name)
+
+    def observe(self, operation, seconds):
+        if not self.enabled:
+            return
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(operation)
+            if histogram is None:
+                histogram = self.histograms[operation] = [0] * (len(self.BUCKETS) + 2)
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    def timed(self, operation):
+        """Decorator recording how long each call takes under operation"""
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(operation, time.perf_counter() - started)
+            return wrapper
+        return decorate
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def state(self):
+        """What was recorded, as json, for merge() in another process"""
+        with self.lock:
+            return {"counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+                    "histograms": {operation: list(histogram) for operation, histogram in self.histograms.items()}}
+
+    def merge(self, state):
+        """Add what another process recorded, as returned by its state()"""
+        with self.lock:
+            for name, labels, value in state["counters"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for operation, histogram in state["histograms"].items():
+                mine = self.histograms.setdefault(operation, [0] * len(histogram))
+                self.histograms[operation] = [a + b for a, b in zip(mine, histogram)]
+
+    def quantile(self, histogram, fraction):
+        """Upper bound of the bucket holding the given fraction of calls, in seconds"""
+        calls = sum(histogram[:-1])
+        seen = 0
+        for bound, bucket in zip(self.BUCKETS, histogram):
+            seen += bucket
+            if seen >= fraction * calls:
+                return bound
+        return float("inf")
+
+    def snapshot(self, gauges=None):
+        """Everything recorded, plus the given gauges, as a json-ready dict"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {operation: list(histogram) for operation, histogram in self.histograms.items()}
+        operations = {}
+        for operation, histogram in sorted(histograms.items()):
+            calls = sum(histogram[:-1])
+            operations[operation] = {
+                "calls": calls,
+                "seconds": round(histogram[-1], 6),
+                "mean_ms": round(histogram[-1] / calls * 1000, 4) if calls else None,
+                # bucket bounds, so "at most" this many ms
+                "p50_ms": self.quantile(histogram, 0.5) * 1000,
+                "p99_ms": self.quantile(histogram, 0.99) * 1000,
+            }
+        return {
+            "enabled": self.enabled,
+            "operations": operations,
+            "counters": {self.series(name, labels): value for (name, labels), value in sorted(counters.items())},
+            "gauges": dict(gauges or {}),
+        }
+
+    @staticmethod
+    def series(name, labels):
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+    def prometheus(self, gauges=None):
+        """Everything recorded, plus the given gauges, in the Prometheus text format"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {operation: list(histogram) for operation, histogram in self.histograms.items()}
+        lines = []
+        if histograms:
+            lines.append("# TYPE library_operation_seconds histogram")
+        for operation, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.BUCKETS + ("+Inf",), histogram):
+                cumulative += bucket
+                lines.append(f'library_operation_seconds_bucket{{operation="{operation}",le="{bound}"}} {cumulative}')
+            lines.append(f'library_operation_seconds_sum{{operation="{operation}"}} {histogram[-1]}')
+            lines.append(f'library_operation_seconds_count{{operation="{operation}"}} {cumulative}')
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{self.series(name, labels)} {value}")
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics(enabled=os.environ.get("LIBRARY_METRICS", "1") != "0")
+
+
+# ============== Search index for books =============
+WORD_RE = re.compile(r"\w+")
+
+
+def fold_text(text):
+    """Lowercase text with accents removed, so "José" and "jose" compare equal"""
+    text = text.lower()
+    if text.isascii():
+        return text
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def one_edit_apart(a, b):
+    """True if one insertion, deletion, substitution or swap of neighbours turns a into b"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) < len(b):
+        return a[i:] == b[i + 1:]
+    return a[i + 1:] == b[i + 1:] or (a[i + 2:] == b[i + 2:] and a[i:i + 2] == b[i:i + 2][::-1])
+
+
+class BookSearchIndex:
+    """Trigram index over book name and author for substring search and ranked search"""
+    FUZZY_MIN_LENGTH = 4    # shorter words must match exactly, one typo changes them too much
+
+    def __init__(self):
+        self.entries = {}   # slot -> (node, folded name, folded author), in catalog order
+        # slots only ever grow, so sorting slots gives catalog order
+        self.grams = {}     # trigram -> set of slots
+        self.short = set()  # slots whose name or author is too short to have a trigram
+        # for typo tolerance, built on the first ranked search
+        self.word_counts = None     # word -> number of books using it
+        self.deletes = None         # word, or word with one letter deleted -> set of words
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @staticmethod
+    def _deletes(word):
+        return {word} | {word[:i] + word[i + 1:] for i in range(len(word))}
+
+    def add(self, slot, node):
+        """Index the book stored in node under the given slot"""
+        book = node.book_data
+        name, author = fold_text(book['name']), sys.intern(fold_text(book['author']))
+        self.entries[slot] = (node, name, author)
+        grams = self.grams
+        for gram in self._trigrams(name) | self._trigrams(author):
+            slots = grams.get(gram)
+            if slots is None:
+                grams[gram] = {slot}
+            else:
+                slots.add(slot)
+        if len(name) < 3 or len(author) < 3:
+            self.short.add(slot)
+        if self.word_counts is not None:
+            self.count_words(name, author, 1)
+
+    def update(self, slot):
+        """Re-index a slot whose book name or author may have changed"""
+        node, old_name, old_author = self.entries[slot]
+        book = node.book_data
+        name, author = fold_text(book['name']), sys.intern(fold_text(book['author']))
+        if (name, author) == (old_name, old_author):
+            return
+
+        old_grams = self._trigrams(old_name) | self._trigrams(old_author)
+        new_grams = self._trigrams(name) | self._trigrams(author)
+        for gram in old_grams - new_grams:
+            slots = self.grams[gram]
+            slots.discard(slot)
+            if not slots:
+                del self.grams[gram]
+        for gram in new_grams - old_grams:
+            self.grams.setdefault(gram, set()).add(slot)
+        self.entries[slot] = (node, name, author)
+        if len(name) < 3 or len(author) < 3:
+            self.short.add(slot)
+        else:
+            self.short.discard(slot)
+        if self.word_counts is not None:
+            self.count_words(old_name, old_author, -1)
+            self.count_words(name, author, 1)
+
+    def put(self, slot, node):
+        """Index node under slot, replacing the book the slot held if any"""
+        if slot not in self.entries:
+            self.add(slot, node)
+            return
+        _, name, author = self.entries[slot]
+        self.entries[slot] = (node, name, author)
+        self.update(slot)
+
+    def remove(self, slot):
+        """Drop a slot from the index"""
+        node, name, author = self.entries.pop(slot)
+        for gram in self._trigrams(name) | self._trigrams(author):
+            slots = self.grams[gram]
+            slots.discard(slot)
+            if not slots:
+                del self.grams[gram]
+        self.short.discard(slot)
+        if self.word_counts is not None:
+            self.count_words(name, author, -1)
+
+    def count_words(self, name, author, change):
+        """Add (change 1) or remove (change -1) one book's words from the vocabulary"""
+        for word in set(WORD_RE.findall(name)) | set(WORD_RE.findall(author)):
+            if len(word) < 3 or not word.isalpha():
+                # numbers and tiny words are never a typo of anything
+                continue
+            count = self.word_counts.get(word, 0) + change
+            if count:
+                self.word_counts[word] = count
+            else:
+                del self.word_counts[word]
+            if count == 1 and change > 0:
+                for key in self._deletes(word):
+                    self.deletes.setdefault(key, set()).add(word)
+            elif count == 0:
+                for key in self._deletes(word):
+                    words = self.deletes[key]
+                    words.discard(word)
+                    if not words:
+                        del self.deletes[key]
+
+    def search(self, keyword):
+        """Return slots whose name or author contains keyword, in catalog order"""
+        keyword = keyword.lower()
+        # text holding the keyword also holds it once folded, so the folded
+        # matches are a superset; keep plain substring search exact, as in sqlite
+        matches = []
+        for slot in sorted(self.containing(fold_text(keyword))):
+            book = self.entries[slot][0].book_data
+            if keyword in book['name'].lower() or keyword in book['author'].lower():
+                matches.append(slot)
+        return matches
+
+    def containing(self, text):
+        """Set of slots whose folded name or author contains text"""
+        if len(text) >= 3:
+            postings = [self.grams.get(gram) for gram in self._trigrams(text)]
+            if not all(postings):
+                return set()
+            postings.sort(key=len)
+            candidates = postings[0].intersection(*postings[1:])
+        else:
+            # too short for a trigram of its own, but every longer text holding
+            # it has a trigram holding it
+            candidates = set(self.short)
+            for gram, slots in self.grams.items():
+                if text in gram:
+                    candidates |= slots
+        entries = self.entries
+        return {slot for slot in candidates if text in entries[slot][1] or text in entries[slot][2]}
+
+    def estimate(self, text):
+        """Upper bound on len(self.containing(text)), without running it"""
+        if len(text) < 3:
+            return len(self.short) + sum(len(slots) for gram, slots in self.grams.items() if text in gram)
+        return min(len(self.grams.get(gram, ())) for gram in self._trigrams(text))
+
+    def similar_words(self, word):
+        """Words of the catalog one edit away from word"""
+        if len(word) < self.FUZZY_MIN_LENGTH or not word.isalpha():
+            return set()
+        if self.word_counts is None:
+            self.word_counts, self.deletes = {}, {}
+            for node, name, author in self.entries.values():
+                self.count_words(name, author, 1)
+        found = set()
+        for key in self._deletes(word):
+            found |= self.deletes.get(key, set())
+        return {other for other in found if other != word and one_edit_apart(word, other)}
+
+    def ranked(self, query, offset=0, limit=10):
+        """(number of matches, slots of the best matches[offset:offset + limit])
+
+        Every word of the query has to be found in the book's name or author:
+        as a whole word, a word prefix, inside a word, or for words of
+        FUZZY_MIN_LENGTH letters or more, one typo away from a word. Name or
+        author equal to the query rank first, then those starting with it,
+        then those containing it, then the rest by how well the words matched.
+        Ties keep catalog order.
+        """
+        query = " ".join(fold_text(query).split())
+        words = WORD_RE.findall(query)
+        if not words:
+            return 0, []
+        
+        # every match holds each word or a typo of it, so only the books holding
+        # the rarest one are candidates; score() checks the other words
+        spellings = min(([word, *self.similar_words(word)] for word in set(words)),
+                        key=lambda spellings: sum(map(self.estimate, spellings)))
+        candidates = set().union(*map(self.containing, spellings))
+        
+        scores = {}
+        for slot in candidates:
+            node, name, author = self.entries[slot]
+            score = self.score(query, words, name, author)
+            if score:
+                scores[slot] = score
+        best = heapq.nsmallest(offset + limit, scores, key=lambda slot: (-scores[slot], slot))
+        return len(scores), best[offset:]
+
+    @classmethod
+    def score(cls, query, words, name, author):
+        """How well a book matches, 0 when some word of the query is missing"""
+        book_words = WORD_RE.findall(name) + WORD_RE.findall(author)
+        total = 0
+        for word in words:
+            best = 0
+            for book_word in book_words:
+                if book_word == word:
+                    best = 3
+                    break
+                if book_word.startswith(word):
+                    best = max(best, 2)
+                elif word in book_word or (len(word) >= cls.FUZZY_MIN_LENGTH and word.isalpha()
+                                           and one_edit_apart(word, book_word)):
+                    best = max(best, 1)
+            if not best:
+                return 0
+            total += best
+        
+        score = 100 * total / (3 * len(words))
+        for text, bonus in ((name, 0), (author, -50)):
+            if text == query:
+                score += 500 + bonus
+            elif text.startswith(query):
+                score += 400 + bonus
+            elif query in text:
+                score += 300 + bonus
+            else:
+                continue
+            break
+        return score
+
+    def node(self, slot):
+        return self.entries[slot][0]
+
+
+class SearchCache:
+    """LRU cache of search results as book ids, with a time to live
+
+    Keys are ("search", lowered keyword) or ("ranked", folded query, offset,
+    limit). Results hold ids rather than books, so borrowing, returning or
+    editing copies never makes them stale; only a book added, removed or
+    renamed can, and invalidate() drops exactly the entries that book matches.
+    """
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()    # key -> (expiry time, result), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """The cached result for key, or None"""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, result):
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, result)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def matches(key, lowered, folded):
+        """True if a book with these (name, author) texts is part of the result cached under key"""
+        if key[0] == "search":
+            return key[1] in lowered[0] or key[1] in lowered[1]
+        query = key[1]
+        return BookSearchIndex.score(query, WORD_RE.findall(query), *folded) > 0
+
+    def invalidate(self, book):
+        """Drop the results a change to book (added, removed, or renamed from or to it) affects"""
+        if not self.entries:
+            return
+        lowered = (book['name'].lower(), book['author'].lower())
+        folded = (fold_text(book['name']), fold_text(book['author']))
+        stale = [key for key in self.entries if self.matches(key, lowered, folded)]
+        for key in stale:
+            del self.entries[key]
+        self.invalidations += len(stale)
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                "invalidations": self.invalidations, "hit_rate": round(self.hits / lookups, 3) if lookups else 0}
+
+
+def slot_position(nodes, slot):
+    """Where a node with this slot goes in a list of nodes sorted by slot"""
+    lo, hi = 0, len(nodes)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if nodes[mid].slot < slot:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def insert_node(nodes, node):
+    if not nodes or nodes[-1].slot < node.slot:
+        nodes.append(node)     # new books have the highest slot
+    else:
+        nodes.insert(slot_position(nodes, node.slot), node)
+
+
+def remove_node(nodes, node):
+    del nodes[slot_position(nodes, node.slot)]
+
+
+class BookFilterIndex:
+    """Availability, author and year indexes for filtered listings
+
+    Every list holds BookNodes in catalog (slot) order. Books are bucketed
+    by year with the distinct years kept sorted, so a year range is two
+    bisects and the buckets between them. Each node remembers the keys it
+    is filed under, so a book changed in place can be moved.
+    """
+    def __init__(self):
+        self.available = []         # nodes of books with copies available
+        self.authors = {}           # lowered author -> nodes
+        self.years = []             # distinct years, sorted
+        self.by_year = {}           # year -> nodes
+        self.available_by_year = {} # year -> nodes of books with copies available
+
+    @staticmethod
+    def keys(book):
+        year = book['year']
+        return (sys.intern(book['author'].lower()), year if isinstance(year, int) else None,
+                book['available_copies'] > 0)
+
+    def add(self, node):
+        node.author_key, node.year, node.available = self.keys(node.book_data)
+        self._link(node)
+
+    def remove(self, node):
+        self._unlink(node)
+
+    def update(self, node):
+        """Move a node whose book changed in place to the lists it belongs in now"""
+        keys = self.keys(node.book_data)
+        if keys != (node.author_key, node.year, node.available):
+            self._unlink(node)
+            node.author_key, node.year, node.available = keys
+            self._link(node)
+
+    def _link(self, node):
+        insert_node(self.authors.setdefault(node.author_key, []), node)
+        if node.available:
+            insert_node(self.available, node)
+        if node.year is not None:
+            if node.year not in self.by_year:
+                bisect.insort(self.years, node.year)
+                self.by_year[node.year] = []
+            insert_node(self.by_year[node.year], node)
+            if node.available:
+                insert_node(self.available_by_year.setdefault(node.year, []), node)
+
+    def _unlink(self, node):
+        self._discard(self.authors, node.author_key, node)
+        if node.available:
+            remove_node(self.available, node)
+        if node.year is not None:
+            if self._discard(self.by_year, node.year, node):
+                del self.years[bisect.bisect_left(self.years, node.year)]
+            if node.available:
+                self._discard(self.available_by_year, node.year, node)
+
+    @staticmethod
+    def _discard(buckets, key, node):
+        """Remove node from buckets[key], True if that emptied the bucket"""
+        nodes = buckets[key]
+        remove_node(nodes, node)
+        if not nodes:
+            del buckets[key]
+            return True
+        return False
+
+    def query(self, available=False, author=None, year_from=None, year_to=None, offset=0, limit=None):
+        """(number of matching books, their nodes[offset:offset + limit])
+
+        author has to match whole, ignoring case. Books come in catalog
+        order, or by year and then catalog order when years are given.
+        """
+        end = None if limit is None else offset + limit
+        by_years = year_from is not None or year_to is not None
+        if author is not None:
+            # an author has few books, filter them directly
+            nodes = [node for node in self.authors.get(author.lower(), ())
+                     if (node.available or not available) and (not by_years or (
+                         node.year is not None and (year_from is None or node.year >= year_from)
+                         and (year_to is None or node.year <= year_to)))]
+            if by_years:
+                nodes.sort(key=lambda node: node.year)
+            return len(nodes), nodes[offset:end]
+        if not by_years:
+            # Library.filter_books lists unfiltered books itself
+            return len(self.available), self.available[offset:end]
+        
+        buckets = self.available_by_year if available else self.by_year
+        lo = 0 if year_from is None else bisect.bisect_left(self.years, year_from)
+        hi = len(self.years) if year_to is None else bisect.bisect_right(self.years, year_to)
+        total, page = 0, []
+        for year in self.years[lo:hi]:
+            nodes = buckets.get(year, ())
+            if end is None or total < end:
+                page.extend(nodes[max(offset - total, 0):None if end is None else end - total])
+            total += len(nodes)
+        return total, page
 
 
 # ============== Linked List for Books =============
 class BookNode:
     """Node for book linked list"""
+    __slots__ = ("book_data", "next", "prev", "slot", "author_key", "year", "available")
+
     def __init__(self, book_data):
         self.book_data = book_data
         self.next = None
+        self.prev = None
+        self.slot = None
+        # the keys BookFilterIndex filed the node under
+        self.author_key = None
+        self.year = None
+        self.available = False
 
 
 class BookLinkedList:
     """Linked list for managing books"""
     def __init__(self):
         self.head = None
+        self.tail = None
         self.size = 0
+        self.search_index = BookSearchIndex()
+        self.filter_index = BookFilterIndex()
+        self.nodes = {}         # id(book_data) -> node
+        self.next_slot = 0
+    
+    def __len__(self):
+        return self.size
+    
+    def __iter__(self):
+        """Iterate over the nodes from head to tail"""
+        current = self.head
+        while current:
+            yield current
+            current = current.next
     
     def add_book(self, book_data):
-        """Add book to linked list"""
+        """Add book to the tail of linked list"""
         new_node = BookNode(book_data)
         
         if self.head is None:
             self.head = new_node
         else:
-            current = self.head
-            while current.next:
-                current = current.next
-            current.next = new_node
+            self.tail.next = new_node
+            new_node.prev = self.tail
+        self.tail = new_node
         
+        new_node.slot = self.next_slot
+        self.next_slot += 1
+        self.nodes[id(book_data)] = new_node
+        self.search_index.add(new_node.slot, new_node)
+        self.filter_index.add(new_node)
         self.size += 1
     
-    def find_all_books_recursive(self, current_node, keyword, results=None):
-        """Recursive function to search for ALL books matching keyword"""
-        if results is None:
-            results = []
-        
-        if current_node is None:
-            return results
+    def remove_book(self, book_data):
+        """Unlink the node holding book_data, returns False if it is not in the list"""
+        node = self.nodes.pop(id(book_data), None)
+        if node is None:
+            return False
         
-        book = current_node.book_data
-        if (keyword.lower() in book['name'].lower() or 
-            keyword.lower() in book['author'].lower()):
-            results.append(current_node)
+        if node.prev:
+            node.prev.next = node.next
+        else:
+            self.head = node.next
+        if node.next:
+            node.next.prev = node.prev
+        else:
+            self.tail = node.prev
         
-        return self.find_all_books_recursive(current_node.next, keyword, results)
+        self.search_index.remove(node.slot)
+        self.filter_index.remove(node)
+        self.size -= 1
+        return True
     
-    def display_all_recursive(self, current_node, count=1):
-        """Recursive function to display all books"""
-        if current_node is None:
-            return
-        
-        book = current_node.book_data
-        status = "Available" if book['available_copies'] > 0 else "Borrowed"
-        print(f"{count}. {book['name']} - {book['author']} ({book['year']}) - {status}")
+    def update_book(self, book_data):
+        """Refresh the index entries of a book changed in place"""
+        node = self.nodes.get(id(book_data))
+        if node is not None:
+            self.search_index.update(node.slot)
+            self.filter_index.update(node)
+    
+    def find_all_books_recursive(self, current_node, keyword, results=None):
+        """Search for ALL books matching keyword from current_node onward"""
+        if results is None:
+            if current_node is self.head:
+                # whole-list search is answered by the index
+                return [self.search_index.node(slot) for slot in self.search_index.search(keyword)]
+            results = []
         
-        self.display_all_recursive(current_node.next, count + 1)
+        keyword = keyword.lower()
+        while current_node is not None:
+            book = current_node.book_data
+            if keyword in book['name'].lower() or keyword in book['author'].lower():
+                results.append(current_node)
+            current_node = current_node.next
+        return results
     
     def count_available_recursive(self):
-        """Count available books recursively"""
-        def _helper(node):
-            if node is None:
-                return 0
-            count = 1 if node.book_data['available_copies'] > 0 else 0
-            return count + _helper(node.next)
-        
-        return _helper(self.head)
+        """Count available books by walking the list; the filter index holds the same number"""
+        count = 0
+        for node in self:
+            if node.book_data['available_copies'] > 0:
+                count += 1
+        return count
     
     def traverse(self):
         """Traverse linked list to get all books"""
-        books_list = []
-        current = self.head
-        while current:
-            books_list.append(current.book_data)
-            current = current.next
-        return books_list
+        return [node.book_data for node in self]
 
 
-# ============== Stack for operation history =============
-class OperationStack:
-    """Stack for operation history"""
-    def __init__(self):
-        self.stack = []
-    
-    def push(self, operation):
-        """Push operation to stack"""
-        self.stack.append(operation)
-        if len(self.stack) > 20:
-            self.stack.pop(0)
-    
-    def pop(self):
-        """Pop operation from stack"""
-        if not self.is_empty():
-            return self.stack.pop()
-        return None
-    
-    def is_empty(self):
-        return len(self.stack) == 0
-    
-    def display(self):
-        """Display operation history"""
-        if self.is_empty():
-            print("Operation history is empty")
-        else:
-            print("Recent Operations:")
-            for i, op in enumerate(reversed(self.stack), 1):
-                print(f"  {i}. {op}")
+# ============== Operation history =============
+class AuditLog:
+    """History of the operations that changed the library, as typed events
 
+    Each event is a dict with id, seq, at (a timestamp), type, user and
+    book_id, plus details of the change. Catalog changes also carry undo, the
+    change that reverses them (see LibraryService.undo). The newest capacity events are kept in a
+    ring buffer with indexes by user and by book, so queries never scan the
+    whole history. Events are also appended to a rotating log file (the file
+    plus backups numbered .1, .2, ...) by a background thread, so recording
+    one is an O(1) step that never waits for the disk; the newest events are
+    read back from the files on start.
+    """
+    TYPES = ("account", "borrow", "return", "add_book", "edit_copies", "remove_book", "import", "undo")
 
-# ============== users acount =============
-class UsersAcount:
-    def __init__(self, filepath="acount_info.csv"):
-        self.save_acc_info = filepath
-        
-        if not os.path.exists(self.save_acc_info):
-            directory = os.path.dirname(self.save_acc_info)
-            if directory and not os.path.exists(directory):
-                os.makedirs(directory, exist_ok=True)
-            with open(self.save_acc_info, "w", encoding="utf-8") as f:
-                pass
+    def __init__(self, filepath="history.log", capacity=10000, max_bytes=1 << 20, backups=5, backlog=100000):
+        self.filepath = filepath
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.ring = [None] * capacity   # event with sequence number seq sits at ring[seq % capacity]
+        self.first_seq = 0              # oldest event still in the ring
+        self.next_seq = 0
+        self.by_user = {}               # user -> deque of seqs, oldest first
+        self.by_book = {}               # book id -> deque of seqs, oldest first
+        self.by_id = {}                 # event id -> seq
+        self.undone = set()             # ids of the events in the ring that were undone
+        self.loaded = False
+        self.deferred_events = None     # events of a deferred() block, recorded when it succeeds
+        self.queue = queue.Queue(maxsize=backlog)   # lines waiting for the writer thread
+        self.writer = None
 
-    def save(self, Username, Password, Borrowed_books):
-        Users = self.loadUser()
-        Users[Username] = {
-            "Password": Password,
-            "Borrowed_books": ",".join([b.strip() for b in Borrowed_books]) if isinstance(Borrowed_books, list) else Borrowed_books
-        }
-        with open(self.save_acc_info, "w", encoding="utf-8") as csv:
-            for user, data in Users.items():
-                csv.write(f"{user},{data['Password']},{data['Borrowed_books']}\n")
+    # ---- recording ----
+    def record(self, event_type, user=None, book_id=None, **detail):
+        """Add an event, returns it"""
+        if event_type not in self.TYPES:
+            raise ValueError(f"unknown event type {event_type!r}")
+        # random rather than counted, so events of several processes never share one
+        event = {"id": os.urandom(6).hex(), "at": time.time(), "type": event_type, "user": user, "book_id": book_id}
+        event.update(detail)
+        if self.deferred_events is not None:
+            self.deferred_events.append(event)
+        else:
+            self.add(event)
+            self.persist(event)
+        return event
 
-    def loadUser(self):
-        Users = {}
-        if not os.path.exists(self.save_acc_info):
-            return Users
-        
+    @contextlib.contextmanager
+    def deferred(self):
+        """Hold back the events recorded in the block until it ends without an error"""
+        if self.deferred_events is not None:
+            yield
+            return
+        self.deferred_events = []
         try:
-            with open(self.save_acc_info, "r", encoding="utf-8") as csv:
-                for line in csv:
-                    line = line.strip()
-                    if line:
-                        parts = line.split(",", 2)
-                        if len(parts) == 3:
-                            Username, Password, Borrowed_books = [x.strip() for x in parts]
-                            Users[Username] = {
-                                "Password": Password,
-                                "Borrowed_books": Borrowed_books
-                            }
-                        elif len(parts) == 2:
-                            Username, Password = [x.strip() for x in parts]
-                            Users[Username] = {
-                                "Password": Password,
-                                "Borrowed_books": ""
-                            }
-        except Exception as e:
-            print(f"Error loading users: {e}")
-        
-        return Users
+            yield
+            events, self.deferred_events = self.deferred_events, None
+        except BaseException:
+            self.deferred_events = None
+            raise
+        for event in events:
+            self.add(event)
+            self.persist(event)
 
-    def createAcount(self, library=None):
-        print("\n=== Create New Account ===")
-        print("(Enter '0' at any time to go back)")
-        Borrowed_books = []
-        
-        while True:
-            Users = self.loadUser()
-            Username = input("\nEnter your Username (or 0 to go back): ").strip()
-            
-            if Username == "0":
-                print("Returning to main menu...")
-                return  # بازگشت به منوی اصلی
-            
-            if not Username:
-                print("Username cannot be empty!")
-                continue
-            
-            if Username in Users:
-                print("This username already exists ❌")
-                print("\n1. Login with existing account")
-                print("2. Try another username")
-                print("0. Go back to main menu")
-                
-                choice = input("Enter your choice: ").strip()
-                
-                if choice == "1":
-                    self.login(library)
-                    return
-                elif choice == "2":
-                    continue
-                elif choice == "0":
-                    print("Returning to main menu...")
-                    return
-                else:
-                    print("Invalid choice! Please try again.")
-                    continue
-            else:
+    def add(self, event):
+        """Put an event in the ring and its indexes, evicting the oldest when full"""
+        self.load()
+        seq = self.next_seq
+        if seq - self.first_seq == self.capacity:
+            self.evict()
+        if seq > self.first_seq:
+            # keep the ring sorted by time, for between(), even if the clock steps back
+            event["at"] = max(event["at"], self.ring[(seq - 1) % self.capacity]["at"])
+        event["seq"] = seq
+        self.ring[seq % self.capacity] = event
+        self.next_seq = seq + 1
+        if event["user"] is not None:
+            self.by_user.setdefault(event["user"], deque()).append(seq)
+        if event["book_id"] is not None:
+            self.by_book.setdefault(event["book_id"], deque()).append(seq)
+        # events written before ids were added have none
+        if "id" in event:
+            self.by_id[event["id"]] = seq
+        if "undoes" in event:
+            self.undone.add(event["undoes"])
+
+    def evict(self):
+        event = self.ring[self.first_seq % self.capacity]
+        self.ring[self.first_seq % self.capacity] = None
+        self.first_seq += 1
+        self.by_id.pop(event.get("id"), None)
+        self.undone.discard(event.get("id"))
+        # the oldest event is the oldest in its indexes too
+        for index, key in ((self.by_user, event["user"]), (self.by_book, event["book_id"])):
+            if key is not None:
+                seqs = index[key]
+                seqs.popleft()
+                if not seqs:
+                    del index[key]
+
+    # ---- file ----
+    def load(self):
+        """Fill the ring with the newest events of the log files, once"""
+        if self.loaded:
+            return
+        self.loaded = True
+        lines = []
+        for path in [self.filepath] + [f"{self.filepath}.{i}" for i in range(1, self.backups + 1)]:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    lines[:0] = f.read().splitlines()
+            except FileNotFoundError:
                 break
+            if len(lines) >= self.capacity:
+                break
+        events = []
+        for line in lines[-self.capacity:]:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # torn by a crash, or still being written by another process
+                continue
+        # several processes append to the same file, so only roughly in order
+        events.sort(key=lambda event: event["at"])
+        for event in events:
+            self.add(event)
+
+    def persist(self, event):
+        """Hand an event to the writer thread; dropped (and counted) if it is far behind"""
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_events, name="history-writer", daemon=True)
+            self.writer.start()
+            atexit.register(self.close)
+        try:
+            # a copy, encoded on the writer thread
+            self.queue.put_nowait(dict(event))
+        except queue.Full:
+            METRICS.count("library_history_dropped_total")
 
+    def write_events(self):
+        """Writer thread: append queued events, as many per write as are waiting"""
         while True:
-            Password = input("\nEnter your password (min 8 chars, or 0 to go back): ")
-            
-            if Password == "0":
-                print("Account creation cancelled.")
+            events = [self.queue.get()]
+            while len(events) < 1000:
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in events
+            # seqs are per process, so they are not saved
+            data = "".join(json.dumps({key: value for key, value in event.items() if key != "seq"},
+                                      ensure_ascii=False, separators=(",", ":")) + "\n"
+                           for event in events if event is not None)
+            if data:
+                try:
+                    self.append(data)
+                except OSError as e:
+                    print(f"❌ Could not write the operation history: {e}", file=sys.stderr)
+            if stop:
                 return
-            
-            if len(Password) >= 8:
-                break
-            print("Password is too short ❌ (must be at least 8 characters)")
 
-        self.save(Username, Password, Borrowed_books)
-        print(f"\n✅ User '{Username}' created successfully!")
-        print("You will now be logged in automatically...")
-        
-        self.login(library)
+    def append(self, data):
+        with FileLock(self.filepath + ".lock"):
+            try:
+                size = os.path.getsize(self.filepath)
+            except OSError:
+                size = 0
+            if size and size + len(data) > self.max_bytes:
+                self.rotate()
+            with open(self.filepath, "a", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                METRICS.file_io("write", self.filepath, len(data))
 
-    def login(self, library=None):
-        print("\n=== User Login ===")
-        print("(Enter '0' at any time to go back)")
-        
-        while True:
-            Users = self.loadUser()
-            Username = input("\nEnter your username (or 0 to go back): ").strip()
-            
-            if Username == "0":
-                print("Returning to main menu...")
-                return
-            
-            if Username not in Users:
-                print("Username not found ❌")
-                print("\n1. Try again")
-                print("2. Create new account")
-                print("0. Go back to main menu")
-                
-                choice = input("Enter your choice: ").strip()
-                
-                if choice == "1":
-                    continue
-                elif choice == "2":
-                    self.createAcount(library)
-                    return
-                elif choice == "0":
-                    return
+    def rotate(self):
+        """history.log becomes history.log.1, .1 becomes .2 and so on; the last backup is dropped"""
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.filepath}.{i}"):
+                os.replace(f"{self.filepath}.{i}", f"{self.filepath}.{i + 1}")
+        os.replace(self.filepath, f"{self.filepath}.1")
+
+    def close(self):
+        """Write out the queued events and stop the writer thread"""
+        if self.writer is not None and self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        self.writer = None
+
+    # ---- queries ----
+    def between(self, since=None, until=None):
+        """Range of seqs of the events with since <= at < until, by binary search"""
+        self.load()
+
+        def first_at(moment):
+            lo, hi = self.first_seq, self.next_seq
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.ring[mid % self.capacity]["at"] < moment:
+                    lo = mid + 1
                 else:
-                    print("Invalid choice!")
+                    hi = mid
+            return lo
+        return (self.first_seq if since is None else first_at(since),
+                self.next_seq if until is None else first_at(until))
+
+    def query(self, user=None, book_id=None, since=None, until=None, types=None, limit=20):
+        """The newest events (up to limit) matching every filter given, newest first"""
+        lo, hi = self.between(since, until)
+        candidates = [seqs for seqs in (self.by_user.get(user, ()) if user is not None else None,
+                                        self.by_book.get(book_id, ()) if book_id is not None else None)
+                      if seqs is not None]
+        seqs = min(candidates, key=len) if candidates else range(lo, hi)
+        events = []
+        for seq in reversed(seqs):
+            if seq >= hi:
                 continue
-            
-            attempts = 3
-            while attempts > 0:
-                Password = input(f"Enter your password (attempts left: {attempts}): ")
-                
-                if Password == "0":
-                    print("Login cancelled.")
-                    return
-                
-                if Password == Users[Username]["Password"]:
-                    print(f"\n✅ Successfully logged in as '{Username}'")
-                    self.acountMenu(Username, Users, library)
-                    return
-                else:
-                    attempts -= 1
-                    if attempts > 0:
-                        print(f"Incorrect password ❌ (attempts left: {attempts})")
-                    else:
-                        print("Too many failed attempts. Returning to main menu...")
-                        return
-            
-            retry = input("\nForgot password? (y/n): ").strip().lower()
-            if retry == 'y':
-                # در واقعیت باید سیستم بازیابی رمز عبور داشته باشیم
-                print("Please contact administrator to reset your password.")
-                return
+            if seq < lo or (limit is not None and len(events) >= limit):
+                break
+            event = self.ring[seq % self.capacity]
+            if user is not None and event["user"] != user:
+                continue
+            if book_id is not None and event["book_id"] != book_id:
+                continue
+            if types is not None and event["type"] not in types:
+                continue
+            events.append(event)
+        return events
 
-    def acountMenu(self, Username, Users, library=None):
-        while True:
-            print(f"\n{'='*50}")
-            print(f"User Panel - Welcome {Username}")
-            print(f"{'='*50}")
-            print("1. 📋 Show account info")
-            print("2. 🔍 Search & Borrow a book")
-            print("3. ↩️  Return a book")
-            print("4. 📚 View all available books")
-            print("5. 🚪 Log out")
-            print(f"{'='*50}")
-            
-            choice = input("Enter your choice: ").strip()
-            
-            if choice == "1":
-                self.username_info(Username, Users)
-                input("\nPress Enter to continue...")
-            elif choice == "2":
-                if library is None:
-                    print("Library not connected ❌")
-                    continue
-                self.borrow_book_menu(Username, Users, library)
-            elif choice == "3":
-                if library is None:
-                    print("Library not connected ❌")
-                    continue
-                self.return_book(Username, Users, library)
-            elif choice == "4":
-                if library is None:
-                    print("Library not connected ❌")
-                    continue
-                self.view_all_books(library)
-            elif choice == "5":
-                print(f"\n👋 Logging out '{Username}'...")
-                return
-            else:
-                print("Invalid choice ❌")
+    def get(self, event_id):
+        """The event with this id, or None once it left the ring"""
+        self.load()
+        seq = self.by_id.get(event_id)
+        return None if seq is None else self.ring[seq % self.capacity]
 
-    def borrow_book_menu(self, Username, Users, library=None):
-        print("\n====== Search & Borrow Books ======")
-        print("(Enter '0' at any time to go back)")
-        
-        keyword = input("\nEnter book name or author to search (or 0 to go back): ").strip()
-        
-        if keyword == "0":
-            return
-        
-        found_nodes = []
-        if library.book_linked_list and library.book_linked_list.head:
-            found_nodes = library.book_linked_list.find_all_books_recursive(
-                library.book_linked_list.head, keyword
-            )
-        
-        if not found_nodes:
-            results = library.search_books(keyword, False)
-            if not results:
-                print("No books found with that keyword ❌")
-                input("\nPress Enter to continue...")
-                return
-            else:
-                print(f"\nFound {len(results)} book(s):")
-                for idx, (i, book) in enumerate(results, 1):
-                    print(f"{idx}. {book['name']} by {book['author']} ({book['year']}) - Copies left: {book['available_copies']}")
-                
-                self.process_borrow_selection(results, Username, Users, library)
-        else:
-            print(f"\nFound {len(found_nodes)} book(s):")
-            for idx, node in enumerate(found_nodes, 1):
-                book = node.book_data
-                print(f"{idx}. {book['name']} by {book['author']} ({book['year']}) - Available copies: {book['available_copies']}")
-            
-            self.process_borrow_selection_found(found_nodes, Username, Users, library)
+    def undoable(self, user, after=None):
+        """The user's changes that can still be undone, newest first
 
-    def process_borrow_selection(self, results, Username, Users, library):
-        while True:
-            bookIndex = input(f"\nEnter number of book to borrow (1 to {len(results)}), 0 to go back: ")
-            
-            if bookIndex == "0":
-                print("Returning to user menu...")
-                return
-            
-            if bookIndex.isdigit() and 1 <= int(bookIndex) <= len(results):
-                selected_index = results[int(bookIndex)-1][0]
-                borrowed_books = Users[Username]["Borrowed_books"].split(",") if Users[Username]["Borrowed_books"] else []
-                
-                if f"{library.books[selected_index]['name']} ({library.books[selected_index]['author']})" in [b.strip() for b in borrowed_books]:
-                    print("You already have this book borrowed ❌")
-                    continue
-                
-                confirm = input(f"Do you want to borrow '{library.books[selected_index]['name']}'? (y/n): ").strip().lower()
-                if confirm == "y":
-                    library.borrow_book(selected_index, Username, self)
-                    Users = self.loadUser()
-                    break
-                elif confirm == "n":
-                    print("Borrow cancelled.")
+        Without after, the changes in effect: changes and redos (undos of
+        undos), but not undos, so undoing repeatedly goes back in time. With after,
+        the events to undo to bring the catalog back to how it was right after
+        that event: of a chain of undos (an undo, an undo of that undo, ...)
+        only the last is not undone yet, and it has an effect left to reverse
+        only if the chain has an odd number of links after that event.
+        """
+        self.load()
+        for seq in reversed(self.by_user.get(user, ())):
+            if after is not None and seq <= after["seq"]:
+                break
+            event = self.ring[seq % self.capacity]
+            if "undo" not in event or event["id"] in self.undone:
+                continue
+            if after is None:
+                if event["type"] != "undo" or event.get("redo"):
+                    yield event
+                continue
+            links, link = 1, event
+            while "undoes" in link:
+                # a link that left the ring is older than after
+                link = self.get(link["undoes"])
+                if link is None or link["seq"] <= after["seq"]:
                     break
-                else:
-                    print("Invalid input. Please enter 'y' or 'n'.")
-            else:
-                print("Invalid selection ❌")
+                links += 1
+            if links % 2:
+                yield event
 
-    def process_borrow_selection_found(self, found_nodes, Username, Users, library):
-        while True:
-            book_choice = input(f"\nEnter number of book to borrow (1 to {len(found_nodes)}), 0 to go back: ")
-            
-            if book_choice == "0":
-                print("Returning to user menu...")
-                return
-            
-            if book_choice.isdigit() and 1 <= int(book_choice) <= len(found_nodes):
-                selected_node = found_nodes[int(book_choice) - 1]
-                selected_book = selected_node.book_data
-                
-                borrowed_books = Users[Username]["Borrowed_books"].split(",") if Users[Username]["Borrowed_books"] else []
-                if f"{selected_book['name']} ({selected_book['author']})" in [b.strip() for b in borrowed_books]:
-                    print("You already have this book borrowed ❌")
-                    continue
-                
-                confirm = input(f"Do you want to borrow '{selected_book['name']}'? (y/n): ").strip().lower()
-                if confirm == "y":
-                    for i, book in enumerate(library.books):
-                        if book['name'] == selected_book['name'] and book['author'] == selected_book['author']:
-                            library.borrow_book(i, Username, self)
-                            Users = self.loadUser()
-                            break
-                    break
-                elif confirm == "n":
-                    print("Borrow cancelled.")
-                    break
-                else:
-                    print("Invalid input. Please enter 'y' or 'n'.")
-            else:
-                print("Invalid selection ❌")
+    def __len__(self):
+        self.load()
+        return self.next_seq - self.first_seq
 
-    def view_all_books(self, library):
-        print("\n=== All Available Books ===")
-        if library.book_linked_list and library.book_linked_list.head:
-            available_count = 0
-            current = library.book_linked_list.head
-            count = 1
-            
-            while current:
-                book = current.book_data
-                if book['available_copies'] > 0:
-                    print(f"{count}. {book['name']} by {book['author']} ({book['year']}) - Available: {book['available_copies']}")
-                    available_count += 1
-                    count += 1
-                current = current.next
-            
-            if available_count == 0:
-                print("No books available at the moment.")
-            else:
-                print(f"\nTotal available books: {available_count}")
+    @staticmethod
+    def describe(event):
+        """One line of text for an event"""
+        kind, user, name = event["type"], event["user"], event.get("name")
+        if kind == "account":
+            text = f"Create account: {user}"
+        elif kind == "borrow":
+            text = f"Borrow book: {name} by {user}"
+        elif kind == "return":
+            text = f"Return book: {name} by {user}"
+        elif kind == "add_book":
+            text = f"Add new book: '{name}'"
+        elif kind == "edit_copies":
+            text = f"Edit copies of '{name}' from {event['before']} to {event['after']}"
+        elif kind == "remove_book":
+            text = f"Remove book: '{name}'"
+        elif kind == "undo":
+            text = f"{'Redo' if event.get('redo') else 'Undo'} {event['of'].replace('_', ' ')}: '{name}'"
         else:
-            print("No books in the library.")
-        
-        input("\nPress Enter to continue...")
+            text = f"Import {event['count']} books from {event['source']}"
+        return f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(event['at']))}  {text}"
 
-    def username_info(self, Username, Users):
-        borrowed = Users[Username]['Borrowed_books']
-        borrowed_list = [b.strip() for b in borrowed.split(",") if b.strip()] if borrowed else []
-        
-        print(f"\n{'='*50}")
-        print(f"Account Information for: {Username}")
-        print(f"{'='*50}")
-        print(f"👤 Username: {Username}")
-        print(f"🔒 Password: {'*' * len(Users[Username]['Password'])}")
-        print(f"\n📚 Borrowed Books:")
-        
-        if borrowed_list:
-            for idx, book in enumerate(borrowed_list, 1):
-                print(f"   {idx}. {book}")
-        else:
-            print("   No books borrowed yet")
-        print(f"{'='*50}")
 
-    def return_book(self, username, Users, library):
-        borrowed = Users[username]['Borrowed_books']
-        borrowed_list = [b.strip() for b in borrowed.split(",") if b.strip()] if borrowed else []
-        
-        if not borrowed_list:
-            print("\n📭 You have no books to return.")
-            input("\nPress Enter to continue...")
-            return
 
-        print(f"\n{'='*50}")
-        print("Your Borrowed Books:")
-        print(f"{'='*50}")
-        
-        for idx, book in enumerate(borrowed_list, 1):
-            print(f"{idx}. {book}")
-        
-        print(f"{'='*50}")
-        
-        while True:
-            sel = input(f"\nEnter number of book to return (1 to {len(borrowed_list)}), 0 to cancel: ")
-            
-            if sel == "0":
-                print("Return cancelled.")
-                return
-            
-            if sel.isdigit() and 1 <= int(sel) <= len(borrowed_list):
-                book_name = borrowed_list[int(sel)-1]
-                found = False
-                
-                for b in library.books:
-                    full_name = f"{b['name']} ({b['author']})"
-                    if full_name == book_name:
-                        b['available_copies'] += 1
-                        found = True
-                        break
-                
-                if found:
-                    borrowed_list.pop(int(sel)-1)
-                    Users[username]["Borrowed_books"] = ", ".join(borrowed_list)
-                    self.save(username, Users[username]["Password"], borrowed_list)
-                    library.save_books()
-                    library.operation_stack.push(f"Return book: {book_name} by {username}")
-                    print(f"\n✅ Book '{book_name}' returned successfully!")
-                    input("\nPress Enter to continue...")
-                    return
+# ============== Safe file storage =============
+def default_file_mode():
+    """Mode open() gives a new file under the current umask"""
+    # the umask can only be read by setting it, done once at import while single threaded
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+DEFAULT_FILE_MODE = default_file_mode()
+
+
+def atomic_write(filepath, write):
+    """Write a file through a temp file and a rename, so it is never left half written"""
+    directory = os.path.dirname(os.path.abspath(filepath))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(filepath) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+            METRICS.file_io("write", filepath, f.tell())
+            METRICS.count("library_fsyncs_total", file=os.path.basename(filepath))
+        # mkstemp creates the file 0600; keep the mode of the file replaced,
+        # or give a new one the mode open() would
+        try:
+            mode = stat.S_IMODE(os.stat(filepath).st_mode)
+        except FileNotFoundError:
+            mode = DEFAULT_FILE_MODE
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+        raise
+    
+    if fcntl is not None:
+        # make the rename itself durable
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def file_stamp(*paths):
+    """Modification time, size and inode of each path, None for missing files"""
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            # atomic_write replaces a file with a new inode, which tells a same
+            # size rewrite apart even within one tick of a coarse mtime
+            stamp.append((st.st_mtime_ns, st.st_size, st.st_ino))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+class FileLock:
+    """Advisory lock on a side file shared by every process using the same data files"""
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.thread_lock = threading.RLock()
+        self.file = None
+        self.depth = 0
+    
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if self.depth == 0:
+            try:
+                self.file = open(self.filepath, "a+")
+                if fcntl is not None:
+                    fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
                 else:
-                    print("Book not found in library database ❌")
+                    self.file.seek(0)
+                    while True:
+                        try:
+                            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            continue
+            except BaseException:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                self.thread_lock.release()
+                raise
+        self.depth += 1
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
             else:
-                print("Invalid selection ❌")
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            self.file.close()
+            self.file = None
+        self.thread_lock.release()
 
 
-# -------------------- Library --------------------
-class Library:
-    def __init__(self, filepath="books.json", txtfile="books.txt"):
+# ============== Journal (write-ahead log) =============
+class Journal:
+    """Append-only log of mutations that compaction folds into a snapshot"""
+    def __init__(self, filepath, compact_every=1000):
         self.filepath = filepath
-        self.txtfile = txtfile
-        self.books = []
-        self.book_linked_list = BookLinkedList()
-        self.operation_stack = OperationStack()
+        self.compact_every = compact_every
+        self.pending = 0    # records written since the last compaction
+        self.offset = 0     # bytes of the log already replayed or written by us
+        self.file = None
 
-        if not os.path.exists(self.txtfile):
-            with open(self.txtfile, "w", encoding="utf-8") as f:
-                pass
+    @METRICS.timed("journal_append")
+    def append(self, *records):
+        """Append records with a single fsync, returns True when compaction is due"""
+        if self.file is None:
+            self.file = open(self.filepath, "a", encoding="utf-8")
+        if os.fstat(self.file.fileno()).st_size > self.offset:
+            # everything complete was replayed before writing, so the rest is a
+            # torn record from a crash; drop it so this one starts on a clean line
+            os.ftruncate(self.file.fileno(), self.offset)
+        self.file.write("".join(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+                                for record in records))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        size = os.fstat(self.file.fileno()).st_size
+        METRICS.file_io("write", self.filepath, size - self.offset)
+        METRICS.count("library_fsyncs_total", file=os.path.basename(self.filepath))
+        self.offset = size
+        self.pending += len(records)
+        return self.pending >= self.compact_every
 
+    def replay(self, start=0):
+        """Return the complete records from byte offset start, stopping at a torn write"""
+        records = []
         if not os.path.exists(self.filepath):
-            with open(self.filepath, "w", encoding="utf-8") as f:
-                json.dump([], f)
-
-        self.load_books(False)
+            self.offset = 0
+            return records
 
-    def load_books(self, isAdmin=False):
-        self.filepath = "books.json"
-        if os.path.exists(self.filepath):
-            with open(self.filepath, "r", encoding="utf-8") as f:
-                self.books = json.load(f)
-        
-        if not self.books and os.path.exists(self.txtfile):
-            with open(self.txtfile, "r", encoding="utf-8") as f:
-                for line in f:
-                    parts = line.strip().split(",")
-                    if len(parts) == 4:
-                        name, author, year, total_copies = parts
-                        self.books.append({
-                            "name": name.strip(),
-                            "author": author.strip(),
-                            "year": int(year),
-                            "total_copies": int(total_copies),
-                            "available_copies": int(total_copies),
-                            "borrowed": False
-                        })
-        
-        self.book_linked_list = BookLinkedList()
-        for book in self.books:
-            self.book_linked_list.add_book(book)
-        
-        if isAdmin:
-            print("\n=== Books in Linked List (Recursive Display) ===")
-            if self.book_linked_list.head:
-                self.book_linked_list.display_all_recursive(self.book_linked_list.head)
-            else:
-                print("No books in the library")
-            
-            total_books = self.book_linked_list.size
-            available_books = self.book_linked_list.count_available_recursive()
-            print(f"\n=== Library Statistics ===")
-            print(f"📚 Total books: {total_books}")
-            print(f"✅ Available books: {available_books}")
-            print(f"📖 Borrowed books: {total_books - available_books}")
-
-    def save_books(self):
-        self.books = self.book_linked_list.traverse()
-        
-        with open(self.filepath, "w", encoding="utf-8") as f:
-            json.dump(self.books, f, indent=4)
-        
-        self.operation_stack.push("Save all books")
+        good_size = start
+        with open(self.filepath, "rb") as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+                good_size += len(line)
 
-    def search_books(self, keyword, isAdmin=False):
-        keyword = keyword.lower()
-        results = []
-        for i, book in enumerate(self.books):
-            if keyword in book["name"].lower() or keyword in book["author"].lower():
-                results.append((i, book))
-        if isAdmin:
-            for idx, (i, book) in enumerate(results, 1):
-                print(f"{idx}. {book['name']} by {book['author']} ({book['year']}) - Copies left: {book['available_copies']}")
-        
-        self.operation_stack.push(f"Search books with keyword: {keyword}")
-        return results
+        METRICS.file_io("read", self.filepath, good_size - start)
+        self.offset = good_size
+        self.pending = len(records) if start == 0 else self.pending + len(records)
+        return records
 
-    def adminSearch(self):
-        print("\n=== Admin Search Books ===")
-        print("(Enter '0' to go back)")
-        
-        keyword = input("\nEnter book name or author to search: ").strip()
-        
-        if keyword == "0":
-            return
-        
-        results = self.search_books(keyword, True)
-        
-        if not results:
-            print("\nNo books found with that keyword.")
-        
-        return results
+    def reset(self):
+        """Empty the log once its records are part of the snapshot"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        with open(self.filepath, "w", encoding="utf-8"):
+            pass
+        self.pending = 0
+        self.offset = 0
 
-    def borrow_book(self, book_index, username, UsersAcount):
-        if book_index < 0 or book_index >= len(self.books):
-            print("Invalid book index ❌")
-            return
-            
-        book = self.books[book_index]
-        Users = UsersAcount.loadUser()
-        
-        if username not in Users:
-            print("User not found ❌")
-            return
-            
-        borrowed_books = Users[username]["Borrowed_books"].split(",") if Users[username]["Borrowed_books"] else []
 
-        if f"{book['name']} ({book['author']})" in [b.strip() for b in borrowed_books]:
-            print(f"You already have this book '{book['name']}' ❌")
-            return
+# ============== Catalog import =============
+IMPORT_FIELDS = ("name", "author", "year", "total_copies", "available_copies")
+# SQLite integers are 64 bit, larger ones overflow
+MAX_INT = (1 << 63) - 1
+JSON_WHITESPACE = re.compile(r"[ \t\r\n]*")
 
-        if book["available_copies"] > 0:
-            book["available_copies"] -= 1
-            if book["available_copies"] == 0:
-                book["borrowed"] = True
 
-            self.book_linked_list = BookLinkedList()
-            for b in self.books:
-                self.book_linked_list.add_book(b)
+def peak_memory_mb():
+    """Peak resident memory of this process in MB, or None where it cannot be read"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
 
-            borrowed_books.append(f"{book['name']} ({book['author']})")
-            Users[username]["Borrowed_books"] = ", ".join(borrowed_books)
-            UsersAcount.save(username, Users[username]["Password"], borrowed_books)
-            self.save_books()
-            
-            self.operation_stack.push(f"Borrow book: {book['name']} by {username}")
-            print(f"\n✅ {username} successfully borrowed '{book['name']}'")
-        else:
-            print("❌ No available copies left for this book")
 
-    def adminEdit(self, book_index):
-        if book_index < 1 or book_index > len(self.books):
-            print("Invalid book index ❌")
-            return
-            
-        book = self.books[book_index - 1]
-        print(f"\n📖 Editing: {book['name']} by {book['author']} ({book['year']})")
-        print(f"   Current copies: {book['available_copies']}")
-        print(f"\n1. Add or remove copies")
-        print("2. Set copies to 0")
-        print("0. Go back")
-        
-        edit_choice = input("\nEnter your choice: ").strip()
+def iter_json_array(f, chunk_size=1 << 20):
+    """Yield the items of the json array in file f, holding only about a chunk of it in memory"""
+    decoder = json.JSONDecoder()
+    name = getattr(f, 'name', 'file')
+    buffer = f.read(chunk_size)
+    while buffer.isspace():
+        buffer = f.read(chunk_size)
+    buffer = buffer.lstrip()
+    if not buffer.startswith("["):
+        raise ValueError(f"{name} does not hold a json array")
+    pos = 1
+    slow_until = 0
+    # what may come next: "first" an item or "]", "item" an item, "next" "," or "]"
+    expect = "first"
+    
+    while True:
+        pos = JSON_WHITESPACE.match(buffer, pos).end()
+        if pos == len(buffer):
+            buffer, pos, slow_until = f.read(chunk_size), 0, 0
+            if not buffer:
+                raise ValueError(f"unterminated json array in {name}")
+            continue
+        char = buffer[pos]
+        if expect == "next" or char in ",]":
+            if char == "]" and expect != "item":
+                # nothing but whitespace may follow the array
+                rest = buffer[pos + 1:]
+                while True:
+                    if rest and not rest.isspace():
+                        raise ValueError(f"unexpected data after the json array in {name}")
+                    rest = f.read(chunk_size)
+                    if not rest:
+                        return
+            if char == "," and expect == "next":
+                pos += 1
+                expect = "item"
+                continue
+            raise ValueError(f"expected {'an item' if expect != 'next' else ', or ]'} in the json array in {name}")
         
-        if edit_choice == "0":
-            print("Edit cancelled.")
-            return
-        elif edit_choice == "1":
-            print("\nEnter number to add or remove (e.g., +2 to add 2, -1 to remove 1)")
-            num_edit = input("Enter number: ").strip()
-            
+        # raw line breaks only occur between json tokens, so when the buffer holds
+        # whole items up to its last line break (books.json has one book per line)
+        # they are decoded in a single call, which also shares their key strings
+        cut = buffer.rfind("\n", pos)
+        if cut > pos and pos >= slow_until:
+            text = buffer[pos:cut].rstrip()
+            more = text.endswith(",")
             try:
-                num_edit = int(num_edit)
-                if book['available_copies'] + num_edit < 0:
-                    print(f"❌ Cannot remove {abs(num_edit)} copies. Only {book['available_copies']} available.")
-                else:
-                    book['available_copies'] += num_edit
-                    print(f"✅ Updated! {book['name']} now has {book['available_copies']} copies available.")
-                    self.save_books()
-                    self.operation_stack.push(f"Edit copies of '{book['name']}' to {book['available_copies']}")
+                items = json.loads("[" + (text[:-1] if more else text) + "]")
             except ValueError:
-                print("❌ Invalid input format. Please enter a number like +2 or -1")
-        
-        elif edit_choice == "2":
-            confirm = input(f"Are you sure you want to set all copies of '{book['name']}' to 0? (y/n): ").strip().lower()
-            if confirm == 'y':
-                book['available_copies'] = 0
-                print(f"✅ {book['name']} now has 0 copies available.")
-                self.save_books()
-                self.operation_stack.push(f"Set copies of '{book['name']}' to 0")
+                # items span lines here, take them one at a time up to the break
+                slow_until = cut
             else:
-                print("Operation cancelled.")
+                yield from items
+                pos = cut
+                expect = "item" if more else "next"
+                continue
+        
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            item, end = None, None
+        # an item cut off by the chunk end, or a number that may go on, needs more input
+        if end is None or end == len(buffer) or buffer[end] in ".eE+-0123456789":
+            chunk = f.read(chunk_size)
+            if chunk:
+                buffer, pos, slow_until = buffer[pos:] + chunk, 0, 0
+                continue
+            if end is None:
+                raise ValueError(f"invalid or unterminated json array in {name}")
+        yield item
+        pos = end
+        expect = "next"
+
+
+def read_catalog_rows(filepath):
+    """Yield (line number, row) from a .txt, .csv, .json or .jsonl catalog without reading it all in"""
+    extension = os.path.splitext(filepath)[1].lower()
+    with open(filepath, "r", encoding="utf-8", newline="") as f:
+        if extension == ".json":
+            for line_no, row in enumerate(iter_json_array(f), 1):
+                yield line_no, row
+        elif extension == ".jsonl":
+            # parsed in parse_book_row so a bad line is rejected instead of ending the import
+            for line_no, line in enumerate(f, 1):
+                if line.strip():
+                    yield line_no, line
         else:
-            print("Invalid choice ❌")
+            # books.txt lines are "name,author,year,total_copies"; a .csv may start with a header
+            header = None
+            for line_no, row in enumerate(csv.reader(f), 1):
+                if not row or not "".join(row).strip():
+                    continue
+                if line_no == 1 and row[0].strip().lower() == "name":
+                    header = [field.strip().lower() for field in row]
+                    continue
+                yield line_no, dict(zip(header, row)) if header else row
 
-    def adminAddorRemoveBook(self):
-        print("\n=== Add or Remove Books ===")
-        print("1. 📝 Add a new book")
-        print("2. ❌ Remove a book")
-        print("0. ↩️  Go back")
+
+def parse_book_row(row):
+    """A new Book from an imported row, raises ValueError when the row is not a valid book"""
+    if isinstance(row, str):
+        row = json.loads(row)
+    if isinstance(row, (list, tuple)):
+        if len(row) not in (4, 5):
+            raise ValueError(f"expected 4 or 5 fields, got {len(row)}")
+        row = dict(zip(IMPORT_FIELDS, row))
+    if not isinstance(row, dict):
+        raise ValueError("not a book record")
+    
+    name = str(row.get("name") or "").strip()
+    author = str(row.get("author") or "").strip()
+    if not name or not author:
+        raise ValueError("missing name or author")
+    try:
+        year = int(row.get("year"))
+        total_copies = int(row.get("total_copies"))
+        available = row.get("available_copies")
+        available_copies = total_copies if available in (None, "") else int(available)
+    except (TypeError, ValueError):
+        raise ValueError("year and copies must be whole numbers")
+    if abs(year) > MAX_INT:
+        raise ValueError("year out of range")
+    if not 0 <= total_copies <= MAX_INT or not 0 <= available_copies <= total_copies:
+        raise ValueError("copies out of range")
+    
+    return Book(name, author, year, total_copies, available_copies)
+
+
+# ============== SQLite storage =============
+def split_book_label(label):
+    """Yield the (name, author) pairs a "Name (Author)" label could stand for"""
+    # the name itself may contain " (", so try every split point
+    if label.endswith(")"):
+        start = label.find(" (")
+        while start != -1:
+            yield label[:start], label[start + 2:-1]
+            start = label.find(" (", start + 1)
+
+
+class SqliteTransaction:
+    """Reentrant write transaction, usable wherever a FileLock is"""
+    def __init__(self, storage):
+        self.storage = storage
+        self.depth = 0
+
+    def __enter__(self):
+        self.storage.thread_lock.acquire()
+        if self.depth == 0:
+            try:
+                # IMMEDIATE takes the write lock up front, so the reads inside the
+                # transaction cannot go stale before the writes
+                self.storage.conn.execute("BEGIN IMMEDIATE")
+            except BaseException:
+                self.storage.thread_lock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        try:
+            if self.depth == 0:
+                self.storage.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+                METRICS.count("library_sqlite_transactions_total", outcome="rollback" if exc_type else "commit")
+        finally:
+            self.storage.thread_lock.release()
+
+
+class SqliteBookList:
+    """Read-only list view of the books table, in insertion order"""
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __len__(self):
+        return self.storage.count_books()
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        row = self.storage.query_one(
+            f"SELECT {SqliteStorage.BOOK_COLUMNS} FROM books ORDER BY id LIMIT 1 OFFSET ?", (index,))
+        if index < 0 or row is None:
+            raise IndexError("book index out of range")
+        return SqliteStorage.book_from_row(row)
+
+    def __iter__(self):
+        # page by id so no cursor is held open between books
+        last_id = 0
+        while True:
+            rows = self.storage.query_all(
+                f"SELECT {SqliteStorage.BOOK_COLUMNS} FROM books WHERE id > ? ORDER BY id LIMIT 500",
+                (last_id,))
+            if not rows:
+                return
+            for row in rows:
+                yield SqliteStorage.book_from_row(row)
+            last_id = rows[-1][0]
+
+
+class SqliteUserMap:
+    """Read-only dict view of users as UsersAcount.loadUser returns them"""
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __contains__(self, Username):
+        return self.storage.query_one("SELECT 1 FROM users WHERE username = ?", (Username,)) is not None
+
+    def __getitem__(self, Username):
+        row = self.storage.query_one("SELECT password FROM users WHERE username = ?", (Username,))
+        if row is None:
+            raise KeyError(Username)
+        return {
+            "Password": row[0],
+            # loans are in their own table, see SqliteStorage.user_loans
+            "Borrowed_books": ""
+        }
+
+    def __len__(self):
+        return self.storage.query_one("SELECT COUNT(*) FROM users")[0]
+
+    def __iter__(self):
+        for row in self.storage.query_all("SELECT username FROM users ORDER BY rowid"):
+            yield row[0]
+
+    def items(self):
+        for Username in self:
+            yield Username, self[Username]
+
+
+class SqliteStorage:
+    """Books, users and loans kept in one SQLite database"""
+    BOOK_COLUMNS = "id, name, author, year, total_copies, available_copies, borrowed"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            author TEXT NOT NULL,
+            year INTEGER,
+            total_copies INTEGER NOT NULL,
+            available_copies INTEGER NOT NULL,
+            borrowed INTEGER NOT NULL DEFAULT 0,
+            name_lower TEXT NOT NULL,
+            author_lower TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS books_name ON books (name);
+        CREATE INDEX IF NOT EXISTS books_author ON books (author);
+        -- for filter_books
+        CREATE INDEX IF NOT EXISTS books_author_lower ON books (author_lower, id);
+        CREATE INDEX IF NOT EXISTS books_year ON books (year, id);
+        CREATE INDEX IF NOT EXISTS books_available ON books (id) WHERE available_copies > 0;
+        CREATE INDEX IF NOT EXISTS books_available_year ON books (year, id) WHERE available_copies > 0;
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS loans (
+            username TEXT NOT NULL REFERENCES users (username) ON DELETE CASCADE,
+            book_id INTEGER NOT NULL REFERENCES books (id) ON DELETE CASCADE,
+            borrowed_at REAL NOT NULL,
+            PRIMARY KEY (username, book_id)
+        );
+        CREATE INDEX IF NOT EXISTS loans_book ON loans (book_id);
+        -- bumped by every change to the book list, so other connections
+        -- know when their search index is out of date
+        CREATE TABLE IF NOT EXISTS catalog_version (version INTEGER NOT NULL);
+        INSERT INTO catalog_version SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM catalog_version);
+        CREATE TRIGGER IF NOT EXISTS books_added AFTER INSERT ON books
+            BEGIN UPDATE catalog_version SET version = version + 1; END;
+        CREATE TRIGGER IF NOT EXISTS books_removed AFTER DELETE ON books
+            BEGIN UPDATE catalog_version SET version = version + 1; END;
+        -- update_book sets every column, so only a real rename counts;
+        -- databases made before that kept a trigger fired by every loan
+        DROP TRIGGER IF EXISTS books_renamed;
+        CREATE TRIGGER IF NOT EXISTS books_name_changed AFTER UPDATE OF name, author ON books
+            WHEN OLD.name IS NOT NEW.name OR OLD.author IS NOT NEW.author
+            BEGIN UPDATE catalog_version SET version = version + 1; END;
+        -- the book behind each of those changes, so a search index can catch
+        -- up with them instead of being built again
+        CREATE TABLE IF NOT EXISTS catalog_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS changes_book_added AFTER INSERT ON books
+            BEGIN INSERT INTO catalog_changes (book_id) VALUES (NEW.id); END;
+        CREATE TRIGGER IF NOT EXISTS changes_book_removed AFTER DELETE ON books
+            BEGIN INSERT INTO catalog_changes (book_id) VALUES (OLD.id); END;
+        DROP TRIGGER IF EXISTS changes_book_renamed;
+        CREATE TRIGGER IF NOT EXISTS changes_book_name_changed AFTER UPDATE OF name, author ON books
+            WHEN OLD.name IS NOT NEW.name OR OLD.author IS NOT NEW.author
+            BEGIN INSERT INTO catalog_changes (book_id) VALUES (NEW.id); END;
+        -- only the latest changes are kept, an index further behind is built again
+        CREATE TRIGGER IF NOT EXISTS changes_trimmed AFTER INSERT ON catalog_changes
+            WHEN NEW.seq % 1024 = 0
+            BEGIN DELETE FROM catalog_changes WHERE seq <= NEW.seq - 8192; END;
+        -- counts kept by the triggers below, so statistics never scan the tables;
+        -- a database made before this table existed is counted once here
+        CREATE TABLE IF NOT EXISTS catalog_stats (
+            books INTEGER NOT NULL,
+            available INTEGER NOT NULL,
+            loans INTEGER NOT NULL
+        );
+        INSERT INTO catalog_stats SELECT
+            (SELECT COUNT(*) FROM books),
+            (SELECT COUNT(*) FROM books WHERE available_copies > 0),
+            (SELECT COUNT(*) FROM loans)
+            WHERE NOT EXISTS (SELECT 1 FROM catalog_stats);
+        CREATE TRIGGER IF NOT EXISTS stats_book_added AFTER INSERT ON books
+            BEGIN UPDATE catalog_stats SET books = books + 1, available = available + (NEW.available_copies > 0); END;
+        CREATE TRIGGER IF NOT EXISTS stats_book_removed AFTER DELETE ON books
+            BEGIN UPDATE catalog_stats SET books = books - 1, available = available - (OLD.available_copies > 0); END;
+        CREATE TRIGGER IF NOT EXISTS stats_book_changed AFTER UPDATE OF available_copies ON books
+            WHEN (OLD.available_copies > 0) != (NEW.available_copies > 0)
+            BEGIN UPDATE catalog_stats SET available = available + (NEW.available_copies > 0) - (OLD.available_copies > 0); END;
+        CREATE TRIGGER IF NOT EXISTS stats_loan_added AFTER INSERT ON loans
+            BEGIN UPDATE catalog_stats SET loans = loans + 1; END;
+        CREATE TRIGGER IF NOT EXISTS stats_loan_removed AFTER DELETE ON loans
+            BEGIN UPDATE catalog_stats SET loans = loans - 1; END;
+    """
+
+    def __init__(self, filepath="library.db"):
+        self.filepath = filepath
+        # autocommit mode, SqliteTransaction issues BEGIN/COMMIT itself
+        self.conn = sqlite3.connect(filepath, timeout=30, isolation_level=None, check_same_thread=False)
+        self.thread_lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(self.SCHEMA)
+        self.lock = SqliteTransaction(self)
+        self.books = SqliteBookList(self)
+        self.users = SqliteUserMap(self)
+
+    @staticmethod
+    def book_from_row(row):
+        return Book(row[1], row[2], row[3], row[4], row[5], bool(row[6]), row[0])
+
+    def query_one(self, sql, params=()):
+        METRICS.count("library_sqlite_reads_total")
+        with self.thread_lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def query_all(self, sql, params=()):
+        METRICS.count("library_sqlite_reads_total")
+        with self.thread_lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    # ---- books ----
+    def get_book(self, book_id):
+        row = self.query_one(f"SELECT {self.BOOK_COLUMNS} FROM books WHERE id = ?", (book_id,))
+        return self.book_from_row(row) if row else None
+
+    def get_books(self, book_ids):
+        """{book id: book} for those of book_ids still in the table"""
+        book_ids = list(book_ids)
+        books = {}
+        # a few hundred at a time, below SQLite's limit on parameters
+        for start in range(0, len(book_ids), 500):
+            chunk = book_ids[start:start + 500]
+            rows = self.query_all(
+                f"SELECT {self.BOOK_COLUMNS} FROM books WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+            books.update((row[0], self.book_from_row(row)) for row in rows)
+        return books
+
+    def find_book(self, name, author):
+        row = self.query_one(
+            f"SELECT {self.BOOK_COLUMNS} FROM books WHERE name = ? AND author = ? ORDER BY id LIMIT 1",
+            (name, author))
+        return self.book_from_row(row) if row else None
+
+    def add_book(self, book):
+        """Insert a book, keeping book['id'] if it has one or storing the new row id in it"""
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO books (id, name, author, year, total_copies, available_copies, borrowed,"
+                " name_lower, author_lower) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (book.id, book['name'], book['author'], book['year'], book['total_copies'],
+                 book['available_copies'], int(book['borrowed']),
+                 book['name'].lower(), book['author'].lower()))
+            book['id'] = cursor.lastrowid
+
+    def add_books(self, books):
+        """Insert many books in one transaction, book['id'] is not filled in"""
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO books (id, name, author, year, total_copies, available_copies, borrowed,"
+                " name_lower, author_lower) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((book.id, book['name'], book['author'], book['year'], book['total_copies'],
+                  book['available_copies'], int(book['borrowed']),
+                  book['name'].lower(), book['author'].lower()) for book in books))
+
+    def add_new_books(self, books):
+        """Insert in one transaction the books whose name and author are not in the table yet, returns how many"""
+        with self.lock:
+            # rowcount, as total_changes would also count the rows the triggers update
+            cursor = self.conn.executemany(
+                "INSERT INTO books (name, author, year, total_copies, available_copies, borrowed,"
+                " name_lower, author_lower) SELECT ?, ?, ?, ?, ?, ?, ?, ?"
+                " WHERE NOT EXISTS (SELECT 1 FROM books WHERE name = ? AND author = ?)",
+                ((book['name'], book['author'], book['year'], book['total_copies'],
+                  book['available_copies'], int(book['borrowed']),
+                  book['name'].lower(), book['author'].lower(), book['name'], book['author']) for book in books))
+            return cursor.rowcount
+
+    def update_book(self, book):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE books SET name = ?, author = ?, year = ?, total_copies = ?, available_copies = ?,"
+                " borrowed = ?, name_lower = ?, author_lower = ? WHERE id = ?",
+                (book['name'], book['author'], book['year'], book['total_copies'],
+                 book['available_copies'], int(book['borrowed']),
+                 book['name'].lower(), book['author'].lower(), book['id']))
+
+    def remove_book(self, book):
+        with self.lock:
+            self.conn.execute("DELETE FROM books WHERE id = ?", (book['id'],))
+
+    def search(self, keyword):
+        """(book id, book) pairs whose name or author contains keyword"""
+        keyword = keyword.lower()
+        rows = self.query_all(
+            f"SELECT {self.BOOK_COLUMNS} FROM books"
+            f" WHERE instr(name_lower, ?) > 0 OR instr(author_lower, ?) > 0 ORDER BY id",
+            (keyword, keyword))
+        return [(row[0], self.book_from_row(row)) for row in rows]
+
+    def filter_books(self, available=False, author=None, year_from=None, year_to=None, offset=0, limit=None):
+        """(number of matching books, books[offset:offset + limit]); see BookFilterIndex.query"""
+        conditions, params = [], []
+        if available:
+            # spelled as in the partial indexes, so SQLite uses them
+            conditions.append("available_copies > 0")
+        if author is not None:
+            conditions.append("author_lower = ?")
+            params.append(author.lower())
+        if year_from is not None:
+            conditions.append("year >= ?")
+            params.append(year_from)
+        if year_to is not None:
+            conditions.append("year <= ?")
+            params.append(year_to)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        order = "year, id" if year_from is not None or year_to is not None else "id"
         
-        AddOrRemove_Choice = input("\nEnter your choice: ").strip()
+        total = self.query_one(f"SELECT COUNT(*) FROM books{where}", params)[0]
+        rows = self.query_all(f"SELECT {self.BOOK_COLUMNS} FROM books{where} ORDER BY {order} LIMIT ? OFFSET ?",
+                              params + [-1 if limit is None else limit, offset])
+        return total, [self.book_from_row(row) for row in rows]
+
+    def count_books(self):
+        return self.query_one("SELECT books FROM catalog_stats")[0]
+
+    def count_available(self):
+        return self.query_one("SELECT available FROM catalog_stats")[0]
+
+    def catalog_version(self):
+        return self.query_one("SELECT version FROM catalog_version")[0]
+
+    def last_catalog_change(self):
+        return self.query_one("SELECT COALESCE(MAX(seq), 0) FROM catalog_changes")[0]
+
+    def catalog_changes(self, after):
+        """(seq, book id) of the changes to the book list made after seq, oldest first"""
+        return self.query_all("SELECT seq, book_id FROM catalog_changes WHERE seq > ? ORDER BY seq", (after,))
+
+    # ---- users and loans ----
+    def user_loans(self, Username):
+        """The user's loans as {book_id: borrowed_at}, oldest first"""
+        rows = self.query_all(
+            "SELECT book_id, borrowed_at FROM loans WHERE username = ? ORDER BY rowid", (Username,))
+        return dict(rows)
+
+    def all_loans(self):
+        """{username: {book_id: borrowed_at}} for every user with loans, oldest loan first"""
+        loans = {}
+        for Username, book_id, borrowed_at in self.query_all(
+                "SELECT username, book_id, borrowed_at FROM loans ORDER BY rowid"):
+            loans.setdefault(Username, {})[book_id] = borrowed_at
+        return loans
+
+    def count_loans(self):
+        return self.query_one("SELECT loans FROM catalog_stats")[0]
+
+    def count_borrowers(self, book_id):
+        return self.query_one("SELECT COUNT(*) FROM loans WHERE book_id = ?", (book_id,))[0]
+
+    def add_loan(self, Username, book_id, borrowed_at=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO loans (username, book_id, borrowed_at) VALUES (?, ?, ?)",
+                (Username, book_id, time.time() if borrowed_at is None else borrowed_at))
+
+    def remove_loan(self, Username, book_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM loans WHERE username = ? AND book_id = ?", (Username, book_id))
+
+    def find_label(self, label):
+        """The book a "Name (Author)" label refers to"""
+        for name, author in split_book_label(label):
+            book = self.find_book(name, author)
+            if book is not None:
+                return book
+        return None
+
+    def put_user(self, Username, Password):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO users (username, password) VALUES (?, ?)"
+                " ON CONFLICT (username) DO UPDATE SET password = excluded.password",
+                (Username, Password))
+
+
+# ============== Menu helpers =============
+def browse_search(service, keyword, page_size=10):
+    """Print the ranked results a page at a time, returns the books of the page the user stopped at"""
+    offset = 0
+    while True:
+        total, results = service.ranked_search(keyword, offset, page_size)
+        if not results:
+            return []
+        if total > page_size:
+            print(f"\nFound {total} book(s), best matches {offset + 1}-{offset + len(results)}:")
+        else:
+            print(f"\nFound {total} book(s):")
+        for idx, book in enumerate(results, 1):
+            print(f"{idx}. {book['name']} by {book['author']} ({book['year']}) - Copies left: {book['available_copies']}")
         
-        if AddOrRemove_Choice == "0":
-            print("Returning to admin menu...")
+        if offset + len(results) >= total:
+            return results
+        if input("\nPress Enter to pick from these, or 'n' for more results: ").strip().lower() != "n":
+            return results
+        offset += page_size
+
+
+def print_books(books):
+    """Print books numbered from 1, with whether a copy is available"""
+    for idx, book in enumerate(books, 1):
+        status = "Available" if book['available_copies'] > 0 else "Borrowed"
+        print(f"{idx}. {book['name']} - {book['author']} ({book['year']}) - {status}")
+
+
+def print_stats(stats):
+    """Print the library statistics returned by LibraryService.stats"""
+    print(f"📚 Total books: {stats['total']}")
+    print(f"✅ Available books: {stats['available']}")
+    print(f"📖 Borrowed books: {stats['borrowed']}")
+
+
+def print_catalog(service):
+    """Print every book and the library statistics, returns the books as numbered"""
+    print("\n=== Books in Linked List (Recursive Display) ===")
+    _, books = service.list_books()
+    if books:
+        print_books(books)
+    else:
+        print("No books in the library")
+    
+    stats = service.stats()
+    print(f"\n=== Library Statistics ===")
+    print_stats(stats)
+    cache = stats["search_cache"]
+    print(f"🔎 Search cache: {cache['size']}/{cache['maxsize']} searches, "
+          f"{cache['hits']} hits, {cache['misses']} misses, {cache['invalidations']} invalidated")
+    return books
+
+
+def print_history(service, events):
+    if not events:
+        print("Operation history is empty")
+    else:
+        print("Recent Operations:")
+        for i, event in enumerate(events, 1):
+            undone = " (undone)" if service.was_undone(event) else ""
+            print(f"  {i}. {AuditLog.describe(event)}{undone}")
+
+
+def ask_book_filters():
+    """Ask for an author and a range of years, returns them as filter_books arguments"""
+    filters = {}
+    author = input("Author (Enter for any): ").strip()
+    if author:
+        filters["author"] = author
+    years = input("Years, e.g. 1990-2000 or 1995 (Enter for any): ").strip()
+    if years:
+        # "1990-2000", "1990-" and "-2000" are ranges, "1995" is one year
+        first, dash, last = years.partition("-")
+        try:
+            year_from = int(first) if first.strip() else None
+            year_to = int(last) if last.strip() else None
+        except ValueError:
+            print("❌ Years must be whole numbers, showing every year")
+            return filters
+        filters["year_from"] = year_from
+        filters["year_to"] = year_to if dash else year_from
+    return filters
+
+
+# ============== users acount =============
+class UsersAcount:
+    def __init__(self, filepath="acount_info.csv", journal=False, storage=None, loans_filepath=None):
+        self.save_acc_info = filepath
+        # loans are kept apart from the accounts, one "username,book_id,borrowed_at" line each
+        self.loans_filepath = loans_filepath or os.path.join(os.path.dirname(filepath), "loans.csv")
+        # with a SqliteStorage users and loans live in its database instead of the csv
+        self.storage = storage
+        # in journal mode each save is appended to <file>.log instead of rewriting the csv
+        self.journal = Journal(filepath + ".log") if journal else None
+        # parsed users and loans, reused until the files on disk change
+        self.users = None
+        self.loans = None       # username -> {book_id: borrowed_at}, only users with loans
+        self.book_loans = None  # book_id -> number of users holding it, kept with self.loans
+        self.loan_total = 0
+        self.users_stamp = None
+        # held around every read-modify-write so several processes can share the files
+        self.lock = FileLock(filepath + ".lock") if storage is None else storage.lock
+        self.pending = None     # records waiting for the end of a batched() block
+        
+        if storage is None and not os.path.exists(self.save_acc_info):
+            directory = os.path.dirname(self.save_acc_info)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            with open(self.save_acc_info, "w", encoding="utf-8") as f:
+                pass
+        
+        if storage is not None and not len(storage.users) and os.path.exists(self.save_acc_info):
+            # first run on a new database, bring the csv users and their loans over
+            csv_users = UsersAcount(filepath, loans_filepath=self.loans_filepath)
+            with storage.lock:
+                for Username, data in csv_users.loadUser().items():
+                    storage.put_user(Username, data["Password"])
+                    for book_id, borrowed_at in csv_users.user_loans(Username).items():
+                        storage.add_loan(Username, book_id, borrowed_at)
+                    for label in [b.strip() for b in data["Borrowed_books"].split(",") if b.strip()]:
+                        book = storage.find_label(label)
+                        if book is not None:
+                            storage.add_loan(Username, book['id'])
+
+    def save(self, Username, Password):
+        if self.storage is not None:
+            self.storage.put_user(Username, Password)
             return
-        elif AddOrRemove_Choice == "2":
-            if not self.books:
-                print("❌ No books to remove")
+        
+        with self.lock:
+            # reload first if another process changed the file, so its users are kept
+            Users = self.loadUser()
+            Users[Username] = {
+                "Password": Password,
+                "Borrowed_books": Users[Username]["Borrowed_books"] if Username in Users else ""
+            }
+            self.persist({"user": Username, "password": Password})
+
+    def create_user(self, Username, Password):
+        """Add a new account, raises UsernameTaken if another one got the name first"""
+        with self.lock:
+            if Username in self.loadUser():
+                raise UsernameTaken("This username already exists")
+            self.save(Username, Password)
+
+    def authenticate(self, Username, Password):
+        """True if the user exists and the password matches"""
+        Users = self.loadUser()
+        return Username in Users and Users[Username]["Password"] == Password
+
+    def user_loans(self, Username):
+        """The user's loans as {book_id: borrowed_at}, oldest first"""
+        if self.storage is not None:
+            return self.storage.user_loans(Username)
+        self.loadUser()
+        return self.loans.get(Username, {})
+
+    def all_loans(self):
+        """{username: {book_id: borrowed_at}} for every user with loans"""
+        if self.storage is not None:
+            return self.storage.all_loans()
+        self.loadUser()
+        return self.loans
+
+    def loan_count(self):
+        """Number of books out on loan"""
+        if self.storage is not None:
+            return self.storage.count_loans()
+        self.loadUser()
+        return self.loan_total
+
+    def borrowers(self, book_id):
+        """Number of users holding a copy of the book"""
+        if self.storage is not None:
+            return self.storage.count_borrowers(book_id)
+        self.loadUser()
+        return self.book_loans.get(book_id, 0)
+
+    def add_loan(self, Username, book_id):
+        """Record that the user borrowed a book"""
+        if self.storage is not None:
+            self.storage.add_loan(Username, book_id)
+            return
+        self.change_loans({"op": "loan", "user": Username, "book_id": book_id, "at": time.time()})
+
+    def remove_loan(self, Username, book_id):
+        """Record that the user returned a book"""
+        if self.storage is not None:
+            self.storage.remove_loan(Username, book_id)
+            return
+        self.change_loans({"op": "return", "user": Username, "book_id": book_id})
+
+    def change_loans(self, record):
+        with self.lock:
+            self.loadUser()
+            self.apply_loan(record)
+            self.persist(record)
+
+    def persist(self, record):
+        """Write an account or loan record now, or at the end of the current batched() block"""
+        if self.pending is not None:
+            self.pending.append(record)
+        else:
+            self.write_records([record])
+
+    def write_records(self, records):
+        """Append records to the journal, or rewrite the csv files they change"""
+        with self.lock:
+            if self.journal is not None:
+                if self.journal.append(*records):
+                    self.compact()
+            else:
+                if any("op" not in record for record in records):
+                    self.write_users(self.loadUser())
+                if any("op" in record for record in records):
+                    self.write_loans()
+            # our own write must not invalidate the cache
+            self.users_stamp = self.file_stamp()
+
+    @contextlib.contextmanager
+    def batched(self):
+        """Hold the lock and write every change made inside the block once, when it ends"""
+        with self.lock:
+            if self.pending is not None or self.storage is not None:
+                # nested, or a SqliteStorage whose lock already is one transaction
+                yield
                 return
-                
-            print("\n📚 Available books to remove:")
-            for idx, book in enumerate(self.books, 1):
-                print(f"{idx}. {book['name']} by {book['author']}")
-            
+            self.pending = []
             try:
-                RemoveBook_index = int(input(f"\nEnter index of book to remove (1 to {len(self.books)}), 0 to cancel: "))
-                
-                if RemoveBook_index == 0:
-                    print("Operation cancelled.")
-                    return
-                
-                if 1 <= RemoveBook_index <= len(self.books):
-                    RemoveBook_book = self.books[RemoveBook_index-1]
-                    confirm = input(f"Are you sure you want to remove '{RemoveBook_book['name']}'? (y/n): ").strip().lower()
-                    
-                    if confirm == 'y':
-                        self.books.remove(RemoveBook_book)
-                        self.book_linked_list = BookLinkedList()
-                        for book in self.books:
-                            self.book_linked_list.add_book(book)
-                        self.save_books()
-                        self.operation_stack.push(f"Remove book: '{RemoveBook_book['name']}'")
-                        print(f"✅ Book '{RemoveBook_book['name']}' removed successfully")
-                    else:
-                        print("Operation cancelled.")
-                else:
-                    print("❌ Invalid index")
-            except ValueError:
-                print("❌ Invalid input")
+                yield
+                records, self.pending = self.pending, None
+                if records:
+                    self.write_records(records)
+            except BaseException:
+                self.pending = None
+                # the cached users may be ahead of the files now, reload them
+                self.users_stamp = None
+                raise
 
-        elif AddOrRemove_Choice == "1":
-            print("\n📝 Adding a new book:")
-            print("(Enter '0' at any time to cancel)")
-            
-            name = input("Enter book name: ").strip()
-            if name == "0":
-                print("Operation cancelled.")
-                return
-                
-            author = input("Enter book author name: ").strip()
-            if author == "0":
-                print("Operation cancelled.")
-                return
-                
-            year = input("Enter year of book: ").strip()
-            if year == "0":
-                print("Operation cancelled.")
+    def apply_loan(self, record):
+        user, book_id = record["user"], record["book_id"]
+        if record["op"] == "loan":
+            loans = self.loans.setdefault(user, {})
+            if book_id in loans:
                 return
-                
-            total_copies = input("Enter total copies of book: ").strip()
-            if total_copies == "0":
-                print("Operation cancelled.")
-                return
-            
-            try:
-                new_book = {
-                    "name": name,
-                    "author": author,
-                    "year": int(year),
-                    "total_copies": int(total_copies),
-                    "available_copies": int(total_copies),
-                    "borrowed": False
-                }
-                self.books.append(new_book)
-                self.book_linked_list.add_book(new_book)
-                self.save_books()
-                self.operation_stack.push(f"Add new book: '{new_book['name']}'")
-                print(f"✅ Book '{new_book['name']}' added successfully")
-            except ValueError:
-                print("❌ Invalid input for year or copies")
+            loans[book_id] = record["at"]
+            change = 1
         else:
-            print("❌ Invalid choice")
+            loans = self.loans.get(user)
+            if not loans or loans.pop(book_id, None) is None:
+                return
+            if not loans:
+                del self.loans[user]
+            change = -1
+        self.loan_total += change
+        self.book_loans[book_id] = self.book_loans.get(book_id, 0) + change
+        if not self.book_loans[book_id]:
+            del self.book_loans[book_id]
 
-    def AdminShowBorrowedBooks(self):
-        if not os.path.exists("acount_info.csv"):
-            print("❌ No user data found")
-            return
+    def write_users(self, Users):
+        def write(csv):
+            for user, data in Users.items():
+                csv.write(f"{user},{data['Password']},{data['Borrowed_books']}\n")
+        atomic_write(self.save_acc_info, write)
+
+    def write_loans(self):
+        def write(csv):
+            for user, loans in self.loans.items():
+                for book_id, borrowed_at in loans.items():
+                    csv.write(f"{user},{book_id},{borrowed_at}\n")
+        atomic_write(self.loans_filepath, write)
+
+    def compact(self):
+        """Fold the journal into acount_info.csv and loans.csv and empty it"""
+        self.write_users(self.loadUser())
+        self.write_loans()
+        self.journal.reset()
+
+    def migrate_loans(self, library):
+        """Turn the old "Name (Author)" borrowed books column into loan records
+
+        Returns (username, label) of the books no longer in the library, which are dropped.
+        """
+        dropped = []
+        if self.storage is not None:
+            return dropped
+        
+        with library.locked(), self.lock:
+            Users = self.loadUser()
+            migrated = False
+            for Username, data in Users.items():
+                labels = [b.strip() for b in data["Borrowed_books"].split(",") if b.strip()]
+                for label in labels:
+                    book = library.find_by_label(label)
+                    if book is not None:
+                        self.apply_loan({"op": "loan", "user": Username, "book_id": book['id'], "at": time.time()})
+                    else:
+                        dropped.append((Username, label))
+                if labels:
+                    data["Borrowed_books"] = ""
+                    migrated = True
             
+            if migrated:
+                self.write_users(Users)
+                self.write_loans()
+                if self.journal is not None:
+                    self.journal.reset()
+                self.users_stamp = self.file_stamp()
+        return dropped
+
+    def file_stamp(self):
+        """file_stamp of the files users are loaded from"""
+        if self.journal is not None:
+            return file_stamp(self.save_acc_info, self.loans_filepath, self.journal.filepath)
+        return file_stamp(self.save_acc_info, self.loans_filepath)
+
+    def loadUser(self):
+        if self.storage is not None:
+            return self.storage.users
+        
+        stamp = self.file_stamp()
+        if self.users is not None and stamp == self.users_stamp:
+            return self.users
+        return self.read_users(stamp)
+
+    @METRICS.timed("load_users")
+    def read_users(self, stamp):
+        """Read users and loans from the csv files (and journal), recounting the loans"""
+        Users = {}
+        self.users = Users
+        self.loans = {}
+        self.book_loans = {}
+        self.loan_total = 0
+        self.users_stamp = stamp
+        if not os.path.exists(self.save_acc_info):
+            return Users
+        
         try:
-            with open("acount_info.csv", "r", encoding="utf-8") as csv:
-                has_data = False
-                print(f"\n{'='*60}")
-                print("📚 Currently Borrowed Books by Users")
-                print(f"{'='*60}")
-                
+            with open(self.save_acc_info, "r", encoding="utf-8") as csv:
+                METRICS.file_io("read", self.save_acc_info, os.fstat(csv.fileno()).st_size)
                 for line in csv:
-                    if line.strip() and "," in line:
-                        parts = line.strip().split(",", 2)
+                    line = line.strip()
+                    if line:
+                        parts = line.split(",", 2)
                         if len(parts) == 3:
                             Username, Password, Borrowed_books = [x.strip() for x in parts]
-                            if Borrowed_books and Borrowed_books != "":
-                                print(f"\n👤 User: {Username}")
-                                print("📖 Borrowed Books:")
-                                books = Borrowed_books.split(",")
-                                for idx, book in enumerate(books, 1):
-                                    print(f"   {idx}. {book.strip()}")
-                                print(f"{'-'*40}")
-                                has_data = True
-                
-                if not has_data:
-                    print("\n📭 No borrowed books found")
-                print(f"{'='*60}")
+                            Users[Username] = {
+                                "Password": Password,
+                                "Borrowed_books": Borrowed_books
+                            }
+                        elif len(parts) == 2:
+                            Username, Password = [x.strip() for x in parts]
+                            Users[Username] = {
+                                "Password": Password,
+                                "Borrowed_books": ""
+                            }
+            
+            if os.path.exists(self.loans_filepath):
+                with open(self.loans_filepath, "r", encoding="utf-8") as csv:
+                    METRICS.file_io("read", self.loans_filepath, os.fstat(csv.fileno()).st_size)
+                    for line in csv:
+                        parts = line.strip().rsplit(",", 2)
+                        if len(parts) == 3:
+                            Username, book_id, borrowed_at = parts
+                            self.apply_loan({"op": "loan", "user": Username, "book_id": int(book_id),
+                                             "at": float(borrowed_at)})
         except Exception as e:
-            print(f"❌ Error reading borrowed books: {e}")
-
-
-# -------------------- admin --------------------
-class Admin:
-    def __init__(self):
-        pass
+            print(f"Error loading users: {e}")
+        
+        if self.journal is not None:
+            for record in self.journal.replay():
+                if "op" in record:
+                    self.apply_loan(record)
+                else:
+                    Users[record["user"]] = {
+                        "Password": record["password"],
+                        # records written before loans had their own file
+                        "Borrowed_books": record.get("borrowed", "")
+                    }
+        
+        return Users
 
-    def adminLogin(self, library):
-        print("\n=== Admin Login ===")
+    def createAcount(self, service):
+        print("\n=== Create New Account ===")
         print("(Enter '0' at any time to go back)")
         
-        adminUsername = input("\nEnter admin username (or 0 to go back): ").strip()
-        
-        if adminUsername == "0":
-            print("Returning to main menu...")
-            return
-        
-        if adminUsername != "admin":
-            print(f"❌ User '{adminUsername}' not found or not an admin")
-            retry = input("\n1. Try again\n2. Return to main menu\nEnter choice: ").strip()
+        while True:
+            Username = input("\nEnter your Username (or 0 to go back): ").strip()
             
-            if retry == "1":
-                self.adminLogin(library)
-            return
-        
-        attempts = 3
-        while attempts > 0:
-            adminPassword = input(f"Enter admin password (attempts left: {attempts}): ")
+            if Username == "0":
+                print("Returning to main menu...")
+                return  # بازگشت به منوی اصلی
             
-            if adminPassword == "0":
-                print("Login cancelled.")
+            try:
+                service.validate_username(Username)
+                break
+            except UsernameTaken:
+                print("This username already exists ❌")
+                print("\n1. Login with existing account")
+                print("2. Try another username")
+                print("0. Go back to main menu")
+                
+                choice = input("Enter your choice: ").strip()
+                
+                if choice == "1":
+                    self.login(service)
+                    return
+                elif choice == "2":
+                    continue
+                elif choice == "0":
+                    print("Returning to main menu...")
+                    return
+                else:
+                    print("Invalid choice! Please try again.")
+                    continue
+            except InvalidInput as e:
+                print(f"{e} ❌")
+
+        while True:
+            Password = input("\nEnter your password (min 8 chars, or 0 to go back): ")
+            
+            if Password == "0":
+                print("Account creation cancelled.")
                 return
             
-            if adminPassword == "admin":
-                print(f"\n✅ Welcome {adminUsername}!")
-                self.adminMenu(library)
+            try:
+                service.create_account(Username, Password)
+                break
+            except InvalidInput as e:
+                print(f"{e} ❌")
+            except LibraryError as e:
+                print(f"{e} ❌")
                 return
-            else:
-                attempts -= 1
-                if attempts > 0:
-                    print(f"❌ Incorrect password! Attempts left: {attempts}")
-                else:
-                    print("❌ Too many failed attempts. Returning to main menu...")
-                    return
 
-    def adminMenu(self, library):
+        print(f"\n✅ User '{Username}' created successfully!")
+        print("You will now be logged in automatically...")
+        
+        self.login(service)
+
+    def login(self, service):
+        print("\n=== User Login ===")
+        print("(Enter '0' at any time to go back)")
+        
         while True:
-            print(f"\n{'='*50}")
-            print("👑 Admin Panel")
-            print(f"{'='*50}")
-            print("1. ✏️  Edit books")
-            print("2. 🔍 Search books")
-            print("3. 📚 Add or remove books")
-            print("4. 👥 Show borrowed books")
-            print("5. 📜 Show operation history (Stack)")
-            print("6. 🔗 Show all books (Linked List)")
-            print("7. 🚪 Exit admin panel")
-            print(f"{'='*50}")
+            Username = input("\nEnter your username (or 0 to go back): ").strip()
             
-            admin_choice = input("\nEnter your choice: ").strip()
+            if Username == "0":
+                print("Returning to main menu...")
+                return
             
-            if admin_choice == "1":
-                library.load_books(True)
-                if library.books:
-                    try:
-                        admin_index = int(input(f"\nEnter book index to edit (1 to {len(library.books)}), 0 to go back: "))
-                        if admin_index == 0:
-                            print("Returning to admin menu...")
-                            continue
-                        library.adminEdit(admin_index)
-                    except ValueError:
-                        print("❌ Invalid index")
+            if not service.user_exists(Username):
+                print("Username not found ❌")
+                print("\n1. Try again")
+                print("2. Create new account")
+                print("0. Go back to main menu")
+                
+                choice = input("Enter your choice: ").strip()
+                
+                if choice == "1":
+                    continue
+                elif choice == "2":
+                    self.createAcount(service)
+                    return
+                elif choice == "0":
+                    return
                 else:
-                    print("❌ No books to edit")
+                    print("Invalid choice!")
+                continue
             
-            elif admin_choice == "2":
-                library.adminSearch()
+            attempts = 3
+            while attempts > 0:
+                Password = input(f"Enter your password (attempts left: {attempts}): ")
                 
-                if library.books:
-                    print("\nOptions:")
-                    print("1. Edit a book from search results")
-                    print("2. Add or remove books")
-                    print("0. Return to admin menu")
-                    
-                    after_search_choice = input("Enter your choice: ").strip()
-                    
-                    if after_search_choice == "1":
-                        try:
-                            admin_index = int(input("Enter book index to edit: "))
-                            library.adminEdit(admin_index)
-                        except ValueError:
-                            print("❌ Invalid index")
-                    elif after_search_choice == "2":
-                        library.adminAddorRemoveBook()
-                    elif after_search_choice == "0":
-                        continue
+                if Password == "0":
+                    print("Login cancelled.")
+                    return
+                
+                try:
+                    service.login(Username, Password)
+                except AuthenticationFailed:
+                    attempts -= 1
+                    if attempts > 0:
+                        print(f"Incorrect password ❌ (attempts left: {attempts})")
                     else:
-                        print("❌ Invalid choice")
+                        print("Too many failed attempts. Returning to main menu...")
+                        return
+                    continue
+                
+                print(f"\n✅ Successfully logged in as '{Username}'")
+                self.acountMenu(Username, service)
+                return
             
-            elif admin_choice == "3":
-                library.load_books(True)
-                library.adminAddorRemoveBook()
+            retry = input("\nForgot password? (y/n): ").strip().lower()
+            if retry == 'y':
+                # در واقعیت باید سیستم بازیابی رمز عبور داشته باشیم
+                print("Please contact administrator to reset your password.")
+                return
+
+    def acountMenu(self, Username, service):
+        while True:
+            print(f"\n{'='*50}")
+            print(f"User Panel - Welcome {Username}")
+            print(f"{'='*50}")
+            print("1. 📋 Show account info")
+            print("2. 🔍 Search & Borrow a book")
+            print("3. ↩️  Return a book")
+            print("4. 📚 View all available books")
+            print("5. 🚪 Log out")
+            print(f"{'='*50}")
             
-            elif admin_choice == "4":
-                library.AdminShowBorrowedBooks()
-                input("\nPress Enter to continue...")
+            choice = input("Enter your choice: ").strip()
             
-            elif admin_choice == "5":
-                print(f"\n{'='*50}")
-                print("📜 Operation History (Last 20 operations)")
-                print(f"{'='*50}")
-                library.operation_stack.display()
+            if choice == "1":
+                self.username_info(Username, service)
                 input("\nPress Enter to continue...")
+            elif choice == "2":
+                self.borrow_book_menu(Username, service)
+            elif choice == "3":
+                self.return_book(Username, service)
+            elif choice == "4":
+                self.view_all_books(service)
+            elif choice == "5":
+                print(f"\n👋 Logging out '{Username}'...")
+                return
+            else:
+                print("Invalid choice ❌")
+
+    def borrow_book_menu(self, Username, service):
+        print("\n====== Search & Borrow Books ======")
+        print("(Enter '0' at any time to go back)")
+        
+        keyword = input("\nEnter book name or author to search (or 0 to go back): ").strip()
+        
+        if keyword == "0":
+            return
+        
+        results = browse_search(service, keyword)
+        if not results:
+            print("No books found with that keyword ❌")
+            input("\nPress Enter to continue...")
+            return
+        
+        self.process_borrow_selection(results, Username, service)
+
+    def process_borrow_selection(self, results, Username, service):
+        while True:
+            bookIndex = input(f"\nEnter number of book to borrow (1 to {len(results)}, "
+                              f"several separated by commas), 0 to go back: ")
             
-            elif admin_choice == "6":
-                print(f"\n{'='*50}")
-                print("🔗 All Books (Linked List Structure)")
-                print(f"{'='*50}")
-                if library.book_linked_list.head:
-                    library.book_linked_list.display_all_recursive(library.book_linked_list.head)
-                    
-                    total_books = library.book_linked_list.size
-                    available_books = library.book_linked_list.count_available_recursive()
-                    
-                    print(f"\n{'='*50}")
-                    print(f"📊 Library Statistics:")
-                    print(f"   📚 Total books: {total_books}")
-                    print(f"   ✅ Available books: {available_books}")
-                    print(f"   📖 Borrowed books: {total_books - available_books}")
-                    print(f"{'='*50}")
+            if bookIndex == "0":
+                print("Returning to user menu...")
+                return
+            
+            numbers = bookIndex.replace(",", " ").split()
+            if len(numbers) > 1:
+                if all(n.isdigit() and 1 <= int(n) <= len(results) for n in numbers):
+                    self.borrow_several([results[int(n) - 1] for n in numbers], Username, service)
+                    break
+                print("Invalid selection ❌")
+                continue
+            
+            if bookIndex.isdigit() and 1 <= int(bookIndex) <= len(results):
+                selected_book = results[int(bookIndex)-1]
+                
+                if service.has_borrowed(Username, selected_book['id']):
+                    print("You already have this book borrowed ❌")
+                    continue
+                
+                confirm = input(f"Do you want to borrow '{selected_book['name']}'? (y/n): ").strip().lower()
+                if confirm == "y":
+                    try:
+                        book = service.borrow(Username, selected_book['id'])
+                        print(f"\n✅ {Username} successfully borrowed '{book['name']}'")
+                    except LibraryError as e:
+                        print(f"❌ {e}")
+                    break
+                elif confirm == "n":
+                    print("Borrow cancelled.")
+                    break
                 else:
-                    print("📭 No books in the library")
-                input("\nPress Enter to continue...")
+                    print("Invalid input. Please enter 'y' or 'n'.")
+            else:
+                print("Invalid selection ❌")
+
+    def borrow_several(self, books, Username, service):
+        confirm = input(f"Do you want to borrow these {len(books)} books? (y/n): ").strip().lower()
+        if confirm != "y":
+            print("Borrow cancelled.")
+            return
+        try:
+            outcomes = service.borrow_many(Username, [book['id'] for book in books])
+        except LibraryError as e:
+            print(f"❌ {e}")
+            return
+        for book, outcome in zip(books, outcomes):
+            if isinstance(outcome, LibraryError):
+                print(f"❌ '{book['name']}': {outcome}")
+            else:
+                print(f"✅ {Username} successfully borrowed '{outcome['name']}'")
+
+    def view_all_books(self, service, page_size=20):
+        print("\n=== All Available Books ===")
+        total, _ = service.list_books(0, 0)
+        if not total:
+            print("No books in the library.")
+            input("\nPress Enter to continue...")
+            return
+        
+        filters = {}
+        offset = 0
+        while True:
+            found, available = service.filter_books(True, offset=offset, limit=page_size, **filters)
+            for count, book in enumerate(available, offset + 1):
+                print(f"{count}. {book['name']} by {book['author']} ({book['year']}) - Available: {book['available_copies']}")
             
-            elif admin_choice == "7":
-                print("👋 Exiting admin panel...")
-                break
+            if not available:
+                print("No books available at the moment." if not filters else "No available books match.")
+            else:
+                print(f"\nTotal available books: {found}")
             
+            more = offset + len(available) < found
+            choice = input("\nPress Enter to continue" + (", 'n' for more" if more else "")
+                           + ", or 'f' to filter by author or years: ").strip().lower()
+            if choice == "n" and more:
+                offset += page_size
+            elif choice == "f":
+                filters = ask_book_filters()
+                offset = 0
+                print()
             else:
-                print("❌ Invalid choice")
+                return
 
+    def username_info(self, Username, service):
+        info = service.account_info(Username)
+        
+        print(f"\n{'='*50}")
+        print(f"Account Information for: {Username}")
+        print(f"{'='*50}")
+        print(f"👤 Username: {Username}")
+        print(f"🔒 Password: {'*' * info['password_length']}")
+        print(f"\n📚 Borrowed Books:")
+        
+        if info["loans"]:
+            for idx, loan in enumerate(info["loans"], 1):
+                print(f"   {idx}. {loan['book']}")
+        else:
+            print("   No books borrowed yet")
+        print(f"{'='*50}")
 
-# -------------------- main --------------------
-def main():
-    library = Library()
-    users = UsersAcount()
-    admin = Admin()
+    def return_book(self, username, service):
+        loans = service.loans(username)
+        
+        if not loans:
+            print("\n📭 You have no books to return.")
+            input("\nPress Enter to continue...")
+            return
+
+        print(f"\n{'='*50}")
+        print("Your Borrowed Books:")
+        print(f"{'='*50}")
+        
+        for idx, loan in enumerate(loans, 1):
+            print(f"{idx}. {loan['book']}")
+        
+        print(f"{'='*50}")
+        
+        while True:
+            sel = input(f"\nEnter number of book to return (1 to {len(loans)}), 0 to cancel: ")
+            
+            if sel == "0":
+                print("Return cancelled.")
+                return
+            
+            if sel.isdigit() and 1 <= int(sel) <= len(loans):
+                loan = loans[int(sel)-1]
+                
+                try:
+                    service.return_book(username, loan['book_id'])
+                except NotBorrowed as e:
+                    print(f"❌ {e}")
+                    input("\nPress Enter to continue...")
+                    return
+                except LibraryError as e:
+                    print(f"❌ {e}")
+                    continue
+                
+                print(f"\n✅ Book '{loan['book']}' returned successfully!")
+                input("\nPress Enter to continue...")
+                return
+            else:
+                print("Invalid selection ❌")
+
+
+# -------------------- Library --------------------
+class Library:
+    def __init__(self, filepath="books.json", txtfile="books.txt", journal=False, storage=None):
+        self.filepath = filepath
+        self.txtfile = txtfile
+        # with a SqliteStorage the books stay in its database and self.books is a view of it
+        self.storage = storage
+        # in journal mode each change is appended to <file>.log instead of rewriting the json
+        self.journal = Journal(filepath + ".log") if journal else None
+        self.books = []
+        self.book_linked_list = BookLinkedList()
+        self.book_positions = None    # id(book) -> index in self.books when the map was built, rebuilt lazily
+        self.removed_positions = []   # sorted book_positions of the books removed since
+        self.book_keys = {}           # (name, author) -> book
+        self.book_ids = {}            # book id -> book
+        self.next_book_id = 1
+        # operations that changed the library, kept next to the data files
+        data_dir = os.path.dirname(os.path.abspath(storage.filepath if storage is not None else filepath))
+        self.history = AuditLog(os.path.join(data_dir, "history.log"))
+        # held around every read-modify-write so several processes can share the files
+        self.lock = FileLock(filepath + ".lock") if storage is None else storage.lock
+        self.books_stamp = None
+        self.load_seconds = 0    # time the last load_books took
+        self.skipped_lines = []  # (line number, error) of the books.txt lines that are not books
+        self.pending = None      # journal records waiting for the end of a batched() block
+        # SQLite mode ranks searches with an index built from the table on demand,
+        # slotted by book id and kept up with catalog_changes after that
+        self.sqlite_index = None
+        self.sqlite_index_version = None
+        self.sqlite_index_change = 0
+        # repeated searches are answered from here; SQLite mode empties it
+        # whenever catalog_version moves, the files kept in memory precisely
+        self.search_cache = SearchCache()
+        self.search_cache_version = None
+
+        if storage is None and not os.path.exists(self.txtfile):
+            with open(self.txtfile, "w", encoding="utf-8") as f:
+                pass
+
+        if storage is None and not os.path.exists(self.filepath):
+            with open(self.filepath, "w", encoding="utf-8") as f:
+                json.dump([], f)
+
+        with self.lock:
+            self.load_books()
+
+    def read_book_files(self):
+        """Yield the books in books.json, or in books.txt when the json is empty"""
+        found = False
+        if os.path.exists(self.filepath):
+            # parsed one book at a time so a large catalog is never in memory twice
+            with open(self.filepath, "r", encoding="utf-8") as f:
+                METRICS.file_io("read", self.filepath, os.fstat(f.fileno()).st_size)
+                for book in iter_json_array(f):
+                    found = True
+                    yield Book.from_dict(book)
+        
+        if not found and os.path.exists(self.txtfile):
+            self.skipped_lines = []
+            for line_no, row in read_catalog_rows(self.txtfile):
+                try:
+                    yield parse_book_row(row)
+                except ValueError as e:
+                    self.skipped_lines.append((line_no, str(e)))
+
+    @METRICS.timed("load_books")
+    def load_books(self):
+        started = time.perf_counter()
+        if self.storage is not None:
+            self.books = self.storage.books
+            if not self.books:
+                # first run on a new database, start from the json/txt catalog
+                self.storage.add_books(self.read_book_files())
+            self.load_seconds = time.perf_counter() - started
+            return
+        
+        # one pass over the file builds the list, the linked list and the lookups;
+        # self.books and the linked list share the same Book records, so changes
+        # to a book are made once and seen through both
+        self.books = []
+        self.book_linked_list = BookLinkedList()
+        self.book_positions = None
+        self.book_keys = {}
+        self.book_ids = {}
+        self.search_cache.clear()
+        missing_ids = []
+        for book in self.read_book_files():
+            self.books.append(book)
+            self.book_linked_list.add_book(book)
+            self.book_keys[(book['name'], book['author'])] = book
+            if book.id is not None:
+                self.book_ids[book['id']] = book
+            else:
+                missing_ids.append(book)
+        self.next_book_id = max(self.book_ids, default=0) + 1
+        
+        # books saved before ids existed get one now, written back below
+        for book in missing_ids:
+            book['id'] = self.next_book_id
+            self.book_ids[book['id']] = book
+            self.next_book_id += 1
+        
+        if self.journal is not None:
+            self.replay_journal(self.journal.replay())
+        if missing_ids:
+            if self.journal is not None:
+                self.compact()
+            else:
+                self.save_books()
+        self.books_stamp = self.file_stamp()
+        self.load_seconds = time.perf_counter() - started
+
+    def catalog_stats(self):
+        """Number of books and number of books with copies available"""
+        if self.storage is not None:
+            return len(self.books), self.storage.count_available()
+        return self.book_linked_list.size, len(self.book_linked_list.filter_index.available)
+
+    @METRICS.timed("save_books")
+    def save_books(self):
+        if self.storage is not None:
+            return
+        with self.lock:
+            atomic_write(self.filepath, lambda f: self.write_books(f))
+            self.books_stamp = self.file_stamp()
+
+    def write_books(self, f):
+        """Write self.books as a json array with one book per line"""
+        # json.dump with indent falls back to the slow pure python encoder,
+        # dumping each book on its own keeps the file readable and uses the C one
+        f.write("[\n")
+        for i, book in enumerate(self.books):
+            f.write((",\n    " if i else "    ") + json.dumps(book.to_dict(), ensure_ascii=False))
+        f.write("\n]\n")
+
+    def save_book(self, book, removed=False):
+        """Persist a change to one book, appending to the journal when enabled"""
+        if self.storage is not None:
+            if not removed:
+                self.storage.update_book(book)
+            return
+        if not removed:
+            self.book_linked_list.update_book(book)
+        if self.journal is None:
+            record = None
+        elif removed:
+            record = {"op": "del", "id": book['id']}
+        else:
+            record = {"op": "put", "book": book.to_dict()}
+        if self.pending is not None:
+            self.pending.append(record)
+        else:
+            self.write_records([record])
+
+    def write_records(self, records):
+        """Append records to the journal, or rewrite books.json when there is none"""
+        if self.journal is None:
+            self.save_books()
+            return
+        with self.lock:
+            if self.journal.append(*records):
+                self.compact()
+            self.books_stamp = self.file_stamp()
+
+    @contextlib.contextmanager
+    def batched(self):
+        """Hold the lock and write every save_book made inside the block once, when it ends"""
+        with self.locked():
+            if self.pending is not None or self.storage is not None:
+                # nested, or a SqliteStorage whose lock already is one transaction
+                yield
+                return
+            self.pending = []
+            try:
+                yield
+                records, self.pending = self.pending, None
+                if records:
+                    self.write_records(records)
+            except BaseException:
+                self.pending = None
+                # self.books may be ahead of the files now, reload them
+                self.books_stamp = None
+                raise
+
+    def compact(self):
+        """Fold the journal into books.json and empty it"""
+        with self.lock:
+            self.save_books()
+            self.journal.reset()
+            self.books_stamp = self.file_stamp()
+
+    def replay_journal(self, records):
+        """Apply journal records on top of the books already loaded"""
+        for record in records:
+            if record["op"] == "put":
+                # records written before books had ids are matched by name and author
+                if "id" in record["book"]:
+                    book = self.book_ids.get(record["book"]["id"])
+                else:
+                    book = self.book_keys.get((record["book"]["name"], record["book"]["author"]))
+                if book is not None:
+                    # the record may rename the book, drop results for both names
+                    self.search_cache.invalidate(book)
+                    book.update(record["book"])
+                    self.book_linked_list.update_book(book)
+                    self.search_cache.invalidate(book)
+                else:
+                    self.add_book(Book.from_dict(record["book"]))
+            elif record["op"] == "del":
+                if "id" in record:
+                    book = self.book_ids.get(record["id"])
+                else:
+                    book = self.book_keys.get((record["name"], record["author"]))
+                if book is not None:
+                    self.remove_book(book)
+
+    def file_stamp(self):
+        """file_stamp of the files books are loaded from"""
+        if self.journal is not None:
+            return file_stamp(self.filepath, self.journal.filepath)
+        return file_stamp(self.filepath)
+
+    def refresh(self):
+        """Pick up changes other processes made to the book files"""
+        if self.storage is not None:
+            return
+        stamp = self.file_stamp()
+        if stamp == self.books_stamp:
+            return
+        
+        if (self.journal is not None and self.books_stamp is not None and stamp[0] == self.books_stamp[0]
+                and stamp[1] is not None and stamp[1][1] >= self.journal.offset):
+            # the snapshot is untouched, so only replay what was appended to the log
+            self.replay_journal(self.journal.replay(self.journal.offset))
+            self.books_stamp = self.file_stamp()
+        else:
+            self.load_books()
+
+    def sync(self):
+        """Pick up changes other processes saved before a read; only a stat when there are none"""
+        if self.storage is None and self.file_stamp() != self.books_stamp:
+            with self.lock:
+                self.refresh()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the book files lock with self.books brought up to date, for a read-modify-write"""
+        with self.lock:
+            self.refresh()
+            yield
+
+    def get_book(self, book_id):
+        """Look a book up by its id"""
+        if self.storage is not None:
+            return self.storage.get_book(book_id)
+        return self.book_ids.get(book_id)
+
+    def get_books(self, book_ids):
+        """A {book id: book} mapping holding those of book_ids still in the library"""
+        if self.storage is not None:
+            return self.storage.get_books(book_ids)
+        return self.book_ids
+
+    def book_label(self, book_id):
+        """ "Name (Author)" of a book, for showing loans"""
+        book = self.get_book(book_id)
+        if book is None:
+            return f"Unknown book #{book_id}"
+        return f"{book['name']} ({book['author']})"
+
+    def find_book(self, name, author):
+        """Look a book up by name and author"""
+        if self.storage is not None:
+            return self.storage.find_book(name, author)
+        return self.book_keys.get((name, author))
+
+    def find_by_label(self, label):
+        """Look a book up by the "Name (Author)" label kept in users' borrowed books"""
+        for name, author in split_book_label(label):
+            book = self.find_book(name, author)
+            if book is not None:
+                return book
+        return None
+
+    def book_position(self, book):
+        """Index of book in self.books"""
+        if self.book_positions is None:
+            self.book_positions = {id(b): i for i, b in enumerate(self.books)}
+            self.removed_positions = []
+        position = self.book_positions[id(book)]
+        # every book removed before this one moved it up by one
+        return position - bisect.bisect_left(self.removed_positions, position)
+
+    def add_book(self, book):
+        """Append a new book to the catalog, giving it an id if it has none"""
+        if self.storage is not None:
+            self.storage.add_book(book)
+            return
+        if book.id is None:
+            book.id = self.next_book_id
+        self.next_book_id = max(self.next_book_id, book['id'] + 1)
+        self.books.append(book)
+        self.book_linked_list.add_book(book)
+        self.book_keys[(book['name'], book['author'])] = book
+        self.book_ids[book['id']] = book
+        if self.book_positions is not None:
+            # counted as if the removed books were still there, see book_position
+            self.book_positions[id(book)] = len(self.books) - 1 + len(self.removed_positions)
+        self.search_cache.invalidate(book)
+
+    def remove_book(self, book):
+        """Remove a book from the catalog"""
+        if self.storage is not None:
+            self.storage.remove_book(book)
+            return
+        del self.books[self.book_position(book)]
+        bisect.insort(self.removed_positions, self.book_positions.pop(id(book)))
+        if len(self.removed_positions) > max(64, len(self.books) // 8):
+            # rebuilt after enough removals that it costs O(1) per removal
+            self.book_positions = None
+        self.book_linked_list.remove_book(book)
+        if self.book_keys.get((book['name'], book['author'])) is book:
+            del self.book_keys[(book['name'], book['author'])]
+        self.book_ids.pop(book['id'], None)
+        self.search_cache.invalidate(book)
+
+    @METRICS.timed("import_books")
+    def import_books(self, filepath, batch_size=10000):
+        """Bulk add the books in a catalog file, skipping invalid rows and books already in the library"""
+        started = time.perf_counter()
+        report = {"imported": 0, "duplicates": 0, "rejected": 0, "errors": []}
+        batch = []
+        batch_keys = set()
+        # cheaper than checking every cached search against every new book
+        self.search_cache.clear()
+        
+        def commit():
+            if self.storage is not None:
+                added = self.storage.add_new_books(batch)
+            else:
+                for book in batch:
+                    self.add_book(book)
+                added = len(batch)
+            report["imported"] += added
+            report["duplicates"] += len(batch) - added
+            batch.clear()
+            batch_keys.clear()
+        
+        # the database commits each batch in its own transaction; the files stay
+        # locked for the whole import and are written once at the end
+        with self.locked() if self.storage is None else contextlib.nullcontext():
+            for line_no, row in read_catalog_rows(filepath):
+                try:
+                    book = parse_book_row(row)
+                except ValueError as e:
+                    report["rejected"] += 1
+                    if len(report["errors"]) < 100:
+                        report["errors"].append((line_no, str(e)))
+                    continue
+                
+                key = (book['name'], book['author'])
+                # the database skips books it already has itself, see add_new_books
+                if key in batch_keys or (self.storage is None and self.find_book(*key) is not None):
+                    report["duplicates"] += 1
+                    continue
+                batch.append(book)
+                batch_keys.add(key)
+                if len(batch) >= batch_size:
+                    commit()
+            
+            if batch:
+                commit()
+            if self.storage is None and report["imported"]:
+                # one snapshot instead of a journal record per book
+                if self.journal is not None:
+                    self.compact()
+                else:
+                    self.save_books()
+        
+        report["seconds"] = time.perf_counter() - started
+        if report["imported"]:
+            self.history.record("import", Admin.USERNAME, count=report["imported"], source=filepath)
+        return report
+
+    @METRICS.timed("filter_books")
+    def filter_books(self, available=False, author=None, year_from=None, year_to=None, offset=0, limit=None):
+        """(number of matching books, books[offset:offset + limit]), served from the filter indexes"""
+        if self.storage is not None:
+            return self.storage.filter_books(available, author, year_from, year_to, offset, limit)
+        end = None if limit is None else offset + limit
+        if not available and author is None and year_from is None and year_to is None:
+            return len(self.books), self.books[offset:end]
+        total, nodes = self.book_linked_list.filter_index.query(available, author, year_from, year_to, offset, limit)
+        return total, [node.book_data for node in nodes]
+
+    def cached_search(self, key):
+        """Result cached under key by search_books or rank_books, or None"""
+        if self.storage is not None:
+            # other connections may have changed the table, no way to tell which books
+            version = self.storage.catalog_version()
+            if version != self.search_cache_version:
+                self.search_cache.clear()
+                self.search_cache_version = version
+        return self.search_cache.get(key)
+
+    @METRICS.timed("search_books")
+    def search_books(self, keyword):
+        """(book id, book) pairs whose name or author contains keyword"""
+        keyword = keyword.lower()
+        key = ("search", keyword)
+        book_ids = self.cached_search(key)
+        if book_ids is not None:
+            books = self.get_books(book_ids)
+            results = [(book_id, books[book_id]) for book_id in book_ids if book_id in books]
+        else:
+            if self.storage is not None:
+                results = self.storage.search(keyword)
+            else:
+                nodes = self.book_linked_list.find_all_books_recursive(self.book_linked_list.head, keyword)
+                results = [(node.book_data['id'], node.book_data) for node in nodes]
+            self.search_cache.put(key, [book_id for book_id, _ in results])
+        return results
+
+    def search_index(self):
+        """The BookSearchIndex over the catalog"""
+        if self.storage is None:
+            return self.book_linked_list.search_index
+        # read before the changes, so a change made in between is not missed
+        version = self.storage.catalog_version()
+        if self.sqlite_index is not None and version == self.sqlite_index_version:
+            return self.sqlite_index
+        changes = None if self.sqlite_index is None else self.storage.catalog_changes(self.sqlite_index_change)
+        if changes is None or changes and changes[0][0] != self.sqlite_index_change + 1:
+            # first use, or the changes it missed are no longer all kept
+            last_change = self.storage.last_catalog_change()
+            index = BookSearchIndex()
+            for book in self.books:
+                index.add(book['id'], BookNode(book))
+            self.sqlite_index, self.sqlite_index_change = index, last_change
+        elif changes:
+            book_ids = {book_id for _, book_id in changes}
+            books = self.storage.get_books(book_ids)
+            for book_id in book_ids:
+                if book_id in books:
+                    self.sqlite_index.put(book_id, BookNode(books[book_id]))
+                elif book_id in self.sqlite_index.entries:
+                    self.sqlite_index.remove(book_id)
+            self.sqlite_index_change = changes[-1][0]
+        self.sqlite_index_version = version
+        return self.sqlite_index
+
+    @METRICS.timed("rank_books")
+    def rank_books(self, query, offset=0, limit=10):
+        """(number of matches, best matching books[offset:offset + limit]) for a ranked search"""
+        key = ("ranked", " ".join(fold_text(query).split()), offset, limit)
+        cached = self.cached_search(key)
+        if cached is not None:
+            total, book_ids = cached
+        else:
+            index = self.search_index()
+            total, slots = index.ranked(query, offset, limit)
+            book_ids = [index.node(slot).book_data['id'] for slot in slots]
+            self.search_cache.put(key, (total, book_ids))
+        # by id, as the SQLite index keeps the books as they were when it was built
+        books = self.get_books(book_ids)
+        return total, [books[book_id] for book_id in book_ids if book_id in books]
+
+
+# -------------------- admin --------------------
+class Admin:
+    USERNAME = "admin"
+    PASSWORD = "admin"
+
+    def adminLogin(self, service):
+        print("\n=== Admin Login ===")
+        print("(Enter '0' at any time to go back)")
+        
+        adminUsername = input("\nEnter admin username (or 0 to go back): ").strip()
+        
+        if adminUsername == "0":
+            print("Returning to main menu...")
+            return
+        
+        if adminUsername != self.USERNAME:
+            print(f"❌ User '{adminUsername}' not found or not an admin")
+            retry = input("\n1. Try again\n2. Return to main menu\nEnter choice: ").strip()
+            
+            if retry == "1":
+                self.adminLogin(service)
+            return
+        
+        attempts = 3
+        while attempts > 0:
+            adminPassword = input(f"Enter admin password (attempts left: {attempts}): ")
+            
+            if adminPassword == "0":
+                print("Login cancelled.")
+                return
+            
+            try:
+                service.admin_login(adminUsername, adminPassword)
+            except AuthenticationFailed:
+                attempts -= 1
+                if attempts > 0:
+                    print(f"❌ Incorrect password! Attempts left: {attempts}")
+                else:
+                    print("❌ Too many failed attempts. Returning to main menu...")
+                    return
+                continue
+            
+            print(f"\n✅ Welcome {adminUsername}!")
+            self.adminMenu(service)
+            return
+
+    def adminMenu(self, service):
+        while True:
+            print(f"\n{'='*50}")
+            print("👑 Admin Panel")
+            print(f"{'='*50}")
+            print("1. ✏️  Edit books")
+            print("2. 🔍 Search books")
+            print("3. 📚 Add or remove books")
+            print("4. 👥 Show borrowed books")
+            print("5. 📜 Show operation history")
+            print("6. 🔗 Show all books (Linked List)")
+            print("7. 🚪 Exit admin panel")
+            print(f"{'='*50}")
+            
+            admin_choice = input("\nEnter your choice: ").strip()
+            
+            if admin_choice == "1":
+                books = print_catalog(service)
+                if books:
+                    try:
+                        admin_index = int(input(f"\nEnter book index to edit (1 to {len(books)}), 0 to go back: "))
+                        if admin_index == 0:
+                            print("Returning to admin menu...")
+                            continue
+                        if not 1 <= admin_index <= len(books):
+                            print("Invalid book index ❌")
+                            continue
+                        self.adminEdit(service, books[admin_index - 1])
+                    except ValueError:
+                        print("❌ Invalid index")
+                else:
+                    print("❌ No books to edit")
+            
+            elif admin_choice == "2":
+                results = self.adminSearch(service)
+                
+                if results:
+                    print("\nOptions:")
+                    print("1. Edit a book from search results")
+                    print("2. Add or remove books")
+                    print("0. Return to admin menu")
+                    
+                    after_search_choice = input("Enter your choice: ").strip()
+                    
+                    if after_search_choice == "1":
+                        try:
+                            admin_index = int(input(f"Enter book index to edit (1 to {len(results)}): "))
+                            if not 1 <= admin_index <= len(results):
+                                raise ValueError
+                            self.adminEdit(service, results[admin_index - 1])
+                        except ValueError:
+                            print("❌ Invalid index")
+                    elif after_search_choice == "2":
+                        self.adminAddorRemoveBook(service)
+                    elif after_search_choice == "0":
+                        continue
+                    else:
+                        print("❌ Invalid choice")
+            
+            elif admin_choice == "3":
+                print_catalog(service)
+                self.adminAddorRemoveBook(service)
+            
+            elif admin_choice == "4":
+                numbered = self.AdminShowBorrowedBooks(service)
+                if numbered:
+                    self.AdminCheckIn(service, numbered)
+                else:
+                    input("\nPress Enter to continue...")
+            
+            elif admin_choice == "5":
+                self.AdminShowHistory(service)
+            
+            elif admin_choice == "6":
+                print(f"\n{'='*50}")
+                print("🔗 All Books (Linked List Structure)")
+                print(f"{'='*50}")
+                _, books = service.list_books()
+                if books:
+                    print_books(books)
+                    stats = service.stats()
+                    
+                    print(f"\n{'='*50}")
+                    print(f"📊 Library Statistics:")
+                    print(f"   📚 Total books: {stats['total']}")
+                    print(f"   ✅ Available books: {stats['available']}")
+                    print(f"   📖 Borrowed books: {stats['borrowed']}")
+                    print(f"{'='*50}")
+                else:
+                    print("📭 No books in the library")
+                input("\nPress Enter to continue...")
+            
+            elif admin_choice == "7":
+                print("👋 Exiting admin panel...")
+                break
+            
+            else:
+                print("❌ Invalid choice")
+
+    def adminSearch(self, service):
+        print("\n=== Admin Search Books ===")
+        print("(Enter '0' to go back)")
+        
+        keyword = input("\nEnter book name or author to search: ").strip()
+        
+        if keyword == "0":
+            return []
+        
+        results = browse_search(service, keyword)
+        if not results:
+            print("\nNo books found with that keyword.")
+        
+        return results
+
+    def adminEdit(self, service, book):
+        print(f"\n📖 Editing: {book['name']} by {book['author']} ({book['year']})")
+        print(f"   Current copies: {book['available_copies']}")
+        print(f"   On loan: {service.borrowers(book['id'])}")
+        print(f"\n1. Add or remove copies")
+        print("2. Set copies to 0")
+        print("0. Go back")
+        
+        edit_choice = input("\nEnter your choice: ").strip()
+        
+        if edit_choice == "0":
+            print("Edit cancelled.")
+            return
+        elif edit_choice == "1":
+            print("\nEnter number to add or remove (e.g., +2 to add 2, -1 to remove 1)")
+            num_edit = input("Enter number: ").strip()
+            
+            try:
+                num_edit = int(num_edit)
+            except ValueError:
+                print("❌ Invalid input format. Please enter a number like +2 or -1")
+                return
+            try:
+                book = service.change_copies(book['id'], num_edit)
+                print(f"✅ Updated! {book['name']} now has {book['available_copies']} copies available.")
+            except LibraryError as e:
+                print(f"❌ {e}")
+        
+        elif edit_choice == "2":
+            confirm = input(f"Are you sure you want to set all copies of '{book['name']}' to 0? (y/n): ").strip().lower()
+            if confirm == 'y':
+                try:
+                    book = service.set_copies(book['id'], 0)
+                    print(f"✅ {book['name']} now has 0 copies available.")
+                except LibraryError as e:
+                    print(f"❌ {e}")
+            else:
+                print("Operation cancelled.")
+        else:
+            print("Invalid choice ❌")
+
+    def adminAddorRemoveBook(self, service):
+        print("\n=== Add or Remove Books ===")
+        print("1. 📝 Add a new book")
+        print("2. ❌ Remove a book")
+        print("0. ↩️  Go back")
+        
+        AddOrRemove_Choice = input("\nEnter your choice: ").strip()
+        
+        if AddOrRemove_Choice == "0":
+            print("Returning to admin menu...")
+            return
+        elif AddOrRemove_Choice == "2":
+            total, books = service.list_books()
+            if not total:
+                print("❌ No books to remove")
+                return
+                
+            print("\n📚 Available books to remove:")
+            for idx, book in enumerate(books, 1):
+                print(f"{idx}. {book['name']} by {book['author']}")
+            
+            try:
+                RemoveBook_index = int(input(f"\nEnter index of book to remove (1 to {total}), 0 to cancel: "))
+                
+                if RemoveBook_index == 0:
+                    print("Operation cancelled.")
+                    return
+                
+                if 1 <= RemoveBook_index <= total:
+                    RemoveBook_book = books[RemoveBook_index-1]
+                    confirm = input(f"Are you sure you want to remove '{RemoveBook_book['name']}'? (y/n): ").strip().lower()
+                    
+                    if confirm == 'y':
+                        try:
+                            service.remove_book(RemoveBook_book['id'])
+                        except LibraryError as e:
+                            print(f"❌ {e}")
+                            return
+                        print(f"✅ Book '{RemoveBook_book['name']}' removed successfully")
+                    else:
+                        print("Operation cancelled.")
+                else:
+                    print("❌ Invalid index")
+            except ValueError:
+                print("❌ Invalid input")
+
+        elif AddOrRemove_Choice == "1":
+            print("\n📝 Adding a new book:")
+            print("(Enter '0' at any time to cancel)")
+            
+            name = input("Enter book name: ").strip()
+            if name == "0":
+                print("Operation cancelled.")
+                return
+                
+            author = input("Enter book author name: ").strip()
+            if author == "0":
+                print("Operation cancelled.")
+                return
+                
+            year = input("Enter year of book: ").strip()
+            if year == "0":
+                print("Operation cancelled.")
+                return
+                
+            total_copies = input("Enter total copies of book: ").strip()
+            if total_copies == "0":
+                print("Operation cancelled.")
+                return
+            
+            try:
+                new_book = service.add_book(name, author, year, total_copies)
+                print(f"✅ Book '{new_book['name']}' added successfully")
+            except LibraryError as e:
+                print(f"❌ {e}")
+        else:
+            print("❌ Invalid choice")
+
+    def AdminShowBorrowedBooks(self, service):
+        """Print every loan, numbered across users, returns the (username, loan) pairs in that order"""
+        borrowed = service.borrowed_books()
+        print(f"\n{'='*60}")
+        print("📚 Currently Borrowed Books by Users")
+        print(f"{'='*60}")
+        
+        numbered = []
+        for Username, loans in borrowed.items():
+            print(f"\n👤 User: {Username}")
+            print("📖 Borrowed Books:")
+            for loan in loans:
+                numbered.append((Username, loan))
+                print(f"   {len(numbered)}. {loan['book']}")
+            print(f"{'-'*40}")
+        
+        if not borrowed:
+            print("\n📭 No borrowed books found")
+        print(f"{'='*60}")
+        return numbered
+
+    def AdminCheckIn(self, service, numbered):
+        """Take back a cart of returned books, picked by their numbers in the borrowed books list"""
+        choice = input("\nEnter the numbers of returned books to check them in (e.g. 1 3 4), "
+                       "or press Enter to continue: ").strip()
+        if not choice:
+            return
+        numbers = choice.replace(",", " ").split()
+        if not all(n.isdigit() and 1 <= int(n) <= len(numbered) for n in numbers):
+            print("❌ Invalid selection")
+            return
+        
+        picked = [numbered[int(n) - 1] for n in dict.fromkeys(numbers)]
+        outcomes = service.return_many([(Username, loan['book_id']) for Username, loan in picked])
+        for (Username, loan), outcome in zip(picked, outcomes):
+            if isinstance(outcome, LibraryError):
+                print(f"❌ {loan['book']} from {Username}: {outcome}")
+            else:
+                print(f"✅ {loan['book']} returned by {Username}")
+
+    def AdminShowHistory(self, service):
+        """Last 20 operations, then the last 20 of one user or one book on request"""
+        filters, title = {}, "Last 20 operations"
+        while True:
+            print(f"\n{'='*50}")
+            print(f"📜 Operation History ({title})")
+            print(f"{'='*50}")
+            events = service.history(**filters)
+            print_history(service, events)
+            
+            choice = input("\nFilter by (u)ser, (b)ook ID, (a)ll; (z) undo or (r) roll back changes; "
+                           "or press Enter to go back: ").strip().lower()
+            if choice == "u":
+                Username = input("Username: ").strip()
+                filters, title = {"user": Username}, f"Last 20 of {Username}"
+            elif choice == "b":
+                try:
+                    book_id = int(input("Book ID: ").strip())
+                except ValueError:
+                    print("❌ Book ID must be a number")
+                    continue
+                filters, title = {"book_id": book_id}, f"Last 20 of book {book_id}"
+            elif choice == "a":
+                filters, title = {}, "Last 20 operations"
+            elif choice == "z":
+                self.AdminUndo(service, events)
+            elif choice == "r":
+                self.AdminRollback(service, events)
+            else:
+                return
+
+    @staticmethod
+    def pick_event(events, choice):
+        """The event at a number of the shown history, None (after saying so) for an invalid one"""
+        if not (choice.isdigit() and 1 <= int(choice) <= len(events)):
+            print("❌ Invalid selection")
+            return None
+        return events[int(choice) - 1]
+
+    def AdminUndo(self, service, events):
+        """Undo the latest change, or the one picked by its number in the history"""
+        choice = input("Number of the operation to undo (Enter for the latest change): ").strip()
+        event = None
+        if choice:
+            event = self.pick_event(events, choice)
+            if event is None:
+                return
+        try:
+            book = service.undo(event["id"] if event else None)
+            print(f"✅ Undone, '{book['name']}' has {book['available_copies']} copies available")
+        except LibraryError as e:
+            print(f"❌ {e}")
+
+    def AdminRollback(self, service, events):
+        """Undo every change made after an operation picked by its number in the history"""
+        event = self.pick_event(events, input("Roll back every change after operation number: ").strip())
+        if event is None:
+            return
+        try:
+            targets = service.rollback_targets(event["id"])
+        except LibraryError as e:
+            print(f"❌ {e}")
+            return
+        if not targets:
+            print("Nothing to roll back")
+            return
+        if input(f"Undo {len(targets)} changes? (y/n): ").strip().lower() != "y":
+            print("Cancelled")
+            return
+        for target, outcome in zip(targets, service.rollback(event["id"])):
+            if isinstance(outcome, LibraryError):
+                print(f"❌ {AuditLog.describe(target)}: {outcome}")
+            else:
+                print(f"✅ Undone {AuditLog.describe(target)}")
+
+
+# -------------------- service --------------------
+class LibraryService:
+    """Everything the library can do, without menus or printing
+
+    Methods take plain arguments and return books, lists and dicts, or raise
+    a LibraryError subclass. The menus and the HTTP API are both built on it.
+    """
+    def __init__(self, library, users):
+        self.library = library
+        self.users = users
+        # set when other processes change the same files; the history in
+        # memory then misses their changes, so undo could pick the wrong one
+        self.shared = False
+
+    @contextlib.contextmanager
+    def batched(self):
+        """Run several changes with one write of the files at the end"""
+        # same lock order as borrow: books first, then users
+        # the events are recorded only once the changes are written
+        with self.library.history.deferred(), self.library.batched(), self.users.batched():
+            yield
+
+    # ---- books ----
+    def get_book(self, book_id):
+        self.library.sync()
+        book = self.library.get_book(book_id)
+        if book is None:
+            raise BookNotFound("This book is no longer in the library")
+        return book
+
+    def search(self, keyword):
+        """Books whose name or author contains keyword"""
+        self.library.sync()
+        return [book for _, book in self.library.search_books(keyword)]
+
+    def ranked_search(self, query, offset=0, limit=10):
+        """(number of matches, best matches[offset:offset + limit]); see BookSearchIndex.ranked"""
+        self.library.sync()
+        return self.library.rank_books(query, offset, limit)
+
+    def list_books(self, offset=0, limit=None):
+        """(number of books, books[offset:offset + limit]) in catalog order"""
+        self.library.sync()
+        # one query in SQLite mode, where books[i] would be one per book
+        return self.library.filter_books(offset=offset, limit=limit)
+
+    def filter_books(self, available=False, author=None, year_from=None, year_to=None, offset=0, limit=None):
+        """(number of matching books, books[offset:offset + limit]); see BookFilterIndex.query"""
+        self.library.sync()
+        return self.library.filter_books(available, author or None, year_from, year_to, offset, limit)
+
+    # ---- accounts ----
+    def user_exists(self, Username):
+        return Username in self.users.loadUser()
+
+    def validate_username(self, Username):
+        """Raise InvalidInput or UsernameTaken if a new account cannot use this name"""
+        # a "/" could not be put in an /accounts/<username> path
+        if not Username or "," in Username or "/" in Username:
+            raise InvalidInput("Username cannot be empty or contain commas or slashes")
+        if self.user_exists(Username):
+            raise UsernameTaken("This username already exists")
+
+    def create_account(self, Username, Password):
+        self.validate_username(Username)
+        if len(Password) < 8:
+            raise InvalidInput("Password is too short (must be at least 8 characters)")
+        self.users.create_user(Username, Password)
+        self.library.history.record("account", Username)
+
+    def login(self, Username, Password):
+        if not self.users.authenticate(Username, Password):
+            raise AuthenticationFailed("Wrong username or password")
+
+    def admin_login(self, Username, Password):
+        if (Username, Password) != (Admin.USERNAME, Admin.PASSWORD):
+            raise AuthenticationFailed("Admin login required")
+
+    def account_info(self, Username):
+        Users = self.users.loadUser()
+        if Username not in Users:
+            raise UserNotFound("User not found")
+        return {
+            "username": Username,
+            "password_length": len(Users[Username]["Password"]),
+            "loans": self.loans(Username),
+        }
+
+    def loans(self, Username):
+        """The user's borrowed books, oldest first, as dicts with book_id, book and borrowed_at"""
+        self.library.sync()
+        return self.describe_loans(self.users.user_loans(Username))
+
+    def describe_loans(self, loans):
+        return [{"book_id": book_id, "book": self.library.book_label(book_id), "borrowed_at": borrowed_at}
+                for book_id, borrowed_at in loans.items()]
+
+    def has_borrowed(self, Username, book_id):
+        return book_id in self.users.user_loans(Username)
+
+    @METRICS.timed("borrow")
+    def borrow(self, Username, book_id):
+        """Lend a copy of a book to a user, returns the book"""
+        library, users = self.library, self.users
+        # check and update under both locks, books first, so another process
+        # cannot take the last copy between the check and the save
+        with library.locked(), users.lock:
+            book = self.get_book(book_id)
+            if Username not in users.loadUser():
+                raise UserNotFound("User not found")
+            if book_id in users.user_loans(Username):
+                raise AlreadyBorrowed(f"You already have this book '{book['name']}'")
+            if book["available_copies"] <= 0:
+                raise NoCopiesLeft("No available copies left for this book")
+            
+            book["available_copies"] -= 1
+            if book["available_copies"] == 0:
+                book["borrowed"] = True
+            users.add_loan(Username, book_id)
+            library.save_book(book)
+        
+        library.history.record("borrow", Username, book_id, name=book['name'])
+        return book
+
+    @METRICS.timed("return_book")
+    def return_book(self, Username, book_id):
+        """Take a borrowed book back from a user, returns the book"""
+        library, users = self.library, self.users
+        # same lock order as borrow: books first, then users
+        with library.locked(), users.lock:
+            if book_id not in users.user_loans(Username):
+                raise NotBorrowed("This book was already returned")
+            book = self.get_book(book_id)
+            
+            book['available_copies'] += 1
+            users.remove_loan(Username, book_id)
+            library.save_book(book)
+        
+        library.history.record("return", Username, book_id, name=book['name'])
+        return book
+
+    # ---- admin ----
+    @METRICS.timed("add_book")
+    def add_book(self, name, author, year, total_copies):
+        """Add a new book to the catalog; year and copies may be strings as typed"""
+        try:
+            book = parse_book_row({"name": name, "author": author, "year": year, "total_copies": total_copies})
+        except ValueError as e:
+            raise InvalidInput(str(e).capitalize())
+        with self.library.locked():
+            self.library.add_book(book)
+            self.library.save_book(book)
+        self.library.history.record("add_book", Admin.USERNAME, book['id'], name=book['name'], undo={"op": "remove"})
+        return book
+
+    @METRICS.timed("change_copies")
+    def change_copies(self, book_id, change):
+        """Add (or with a negative change remove) available copies of a book, returns the book"""
+        with self.library.locked():
+            book = self.get_book(book_id)
+            if book['available_copies'] + change < 0:
+                raise Conflict(f"Cannot remove {abs(change)} copies. Only {book['available_copies']} available.")
+            if book['available_copies'] + change > MAX_INT:
+                raise InvalidInput("Too many copies")
+            book['available_copies'] += change
+            self.library.save_book(book)
+        
+        self.library.history.record("edit_copies", Admin.USERNAME, book_id, name=book['name'],
+                                    before=book['available_copies'] - change, after=book['available_copies'],
+                                    undo={"op": "change", "change": -change})
+        return book
+
+    def set_copies(self, book_id, available_copies):
+        if available_copies < 0:
+            raise InvalidInput("Available copies cannot be negative")
+        with self.library.locked():
+            book = self.get_book(book_id)
+            return self.change_copies(book_id, available_copies - book['available_copies'])
+
+    @METRICS.timed("remove_book")
+    def remove_book(self, book_id):
+        """Remove a book from the catalog, returns the removed book"""
+        with self.library.locked():
+            book = self.get_book(book_id)
+            self.check_not_on_loan(book)
+            self.library.remove_book(book)
+            self.library.save_book(book, removed=True)
+        self.library.history.record("remove_book", Admin.USERNAME, book_id, name=book['name'],
+                                    undo={"op": "restore", "book": book.to_dict()})
+        return book
+
+    def check_not_on_loan(self, book):
+        """Raise Conflict if someone holds a copy; borrowing needs the library lock too"""
+        # the loans would outlive the book in the files, and be dropped with it in SQLite
+        if self.borrowers(book['id']):
+            raise Conflict(f"'{book['name']}' is on loan and cannot be removed until it is returned")
+
+    # ---- undo ----
+    def check_undo(self):
+        if self.shared:
+            raise Conflict("Undo is not available with several worker processes")
+
+    def undo_target(self, event_id=None):
+        """The admin change undo(event_id) would reverse"""
+        self.check_undo()
+        history = self.library.history
+        if event_id is None:
+            event = next(history.undoable(Admin.USERNAME), None)
+            if event is None:
+                raise NotFound("There is no change left to undo")
+            return event
+        event = history.get(event_id)
+        if event is None:
+            raise NotFound("This operation is not in the history")
+        if "undo" not in event:
+            raise Conflict("This operation cannot be undone")
+        if event_id in history.undone:
+            raise Conflict("This operation was already undone")
+        return event
+
+    def undo(self, event_id=None):
+        """Reverse one catalog change (by default the latest one not undone yet), returns the book
+
+        Only the book the change touched is written back, from the inverse
+        the change recorded. The undo is itself recorded, and can be undone.
+        """
+        library = self.library
+        with library.locked():
+            event = self.undo_target(event_id)
+            delta = event["undo"]
+            if delta["op"] == "restore":
+                if library.get_book(event["book_id"]) is not None:
+                    raise Conflict("A book with this id is in the catalog again")
+                book = Book.from_dict(delta["book"])
+                library.add_book(book)
+                library.save_book(book)
+                inverse = {"op": "remove"}
+            else:
+                book = self.get_book(event["book_id"])
+                if delta["op"] == "remove":
+                    self.check_not_on_loan(book)
+                    inverse = {"op": "restore", "book": book.to_dict()}
+                    library.remove_book(book)
+                    library.save_book(book, removed=True)
+                else:
+                    if book['available_copies'] + delta["change"] < 0:
+                        raise Conflict(f"Cannot remove {-delta['change']} copies. "
+                                       f"Only {book['available_copies']} available.")
+                    book['available_copies'] += delta["change"]
+                    library.save_book(book)
+                    inverse = {"op": "change", "change": -delta["change"]}
+        
+        # of is the change the chain of undos started from; undoing an undo redoes it
+        library.history.record("undo", Admin.USERNAME, event["book_id"], name=book['name'],
+                               of=event.get("of", event["type"]), redo=event["type"] == "undo" and not event.get("redo"),
+                               undoes=event["id"], undo=inverse)
+        return book
+
+    def rollback_targets(self, event_id):
+        """The changes rollback(event_id) would undo, newest first"""
+        self.check_undo()
+        after = self.library.history.get(event_id)
+        if after is None:
+            raise NotFound("This operation is not in the history")
+        return list(self.library.history.undoable(Admin.USERNAME, after))
+
+    def rollback(self, event_id):
+        """Undo every catalog change made after an operation, newest first; see apply_each"""
+        return self.apply_each(self.undo, [(event["id"],) for event in self.rollback_targets(event_id)])
+
+    # ---- bulk ----
+    def apply_each(self, change, items):
+        """Call change(*item) for every item, writing the files once at the end
+
+        Returns, for each item, the book it changed or the LibraryError that
+        refused it; a refused item does not stop the others.
+        """
+        outcomes = []
+        with self.batched():
+            for item in items:
+                try:
+                    outcomes.append(change(*item))
+                except LibraryError as e:
+                    outcomes.append(e)
+        return outcomes
+
+    @METRICS.timed("borrow_many")
+    def borrow_many(self, Username, book_ids):
+        """Lend several books to one user; see apply_each"""
+        if Username not in self.users.loadUser():
+            raise UserNotFound("User not found")
+        return self.apply_each(self.borrow, [(Username, book_id) for book_id in book_ids])
+
+    @METRICS.timed("return_many")
+    def return_many(self, returns):
+        """Take back (username, book_id) pairs, such as a cart from the returns desk; see apply_each"""
+        return self.apply_each(self.return_book, returns)
+
+    @METRICS.timed("change_copies_many")
+    def change_copies_many(self, changes):
+        """Apply (book_id, change) copy adjustments; see apply_each"""
+        return self.apply_each(self.change_copies, changes)
+
+    def borrowed_books(self):
+        """{username: loans} for every user with borrowed books"""
+        self.library.sync()
+        return {Username: self.describe_loans(loans) for Username, loans in self.users.all_loans().items()}
+
+    def borrowers(self, book_id):
+        """Number of users holding a copy of the book"""
+        return self.users.borrowers(book_id)
+
+    def history(self, user=None, book_id=None, since=None, until=None, types=None, limit=20):
+        """Recent operations, newest first; see AuditLog.query"""
+        return self.library.history.query(user, book_id, since, until, types, limit)
+
+    def was_undone(self, event):
+        """Whether an event returned by history() has been undone"""
+        return event.get("id") in self.library.history.undone
+
+    def stats(self):
+        self.library.sync()
+        total_books, available_books = self.library.catalog_stats()
+        return {"total": total_books, "available": available_books, "borrowed": total_books - available_books,
+                "borrowed_copies": self.users.loan_count(), "search_cache": self.library.search_cache.stats()}
+
+    def gauges(self):
+        """Current sizes of the library, read from the running counters"""
+        self.library.sync()
+        total_books, available_books = self.library.catalog_stats()
+        cache = self.library.search_cache.stats()
+        return {
+            "library_books": total_books,
+            "library_books_available": available_books,
+            "library_copies_on_loan": self.users.loan_count(),
+            "library_users": len(self.users.loadUser()),
+            "library_search_cache_entries": cache["size"],
+            "library_search_cache_hits_total": cache["hits"],
+            "library_search_cache_misses_total": cache["misses"],
+            "library_search_cache_invalidations_total": cache["invalidations"],
+        }
+
+    def metrics(self):
+        """Operation latencies, counters and gauges as a dict"""
+        return METRICS.snapshot(self.gauges())
+
+    def metrics_text(self):
+        """The same in the Prometheus text format"""
+        return METRICS.prometheus(self.gauges())
+
+
+# -------------------- async engine --------------------
+class LibraryEngine:
+    """Runs LibraryService calls for an asyncio event loop
+
+    Library and UsersAcount are not thread safe, so every call runs on one
+    worker thread, which also keeps file writes off the event loop. Changes
+    to a book first take that book's asyncio lock, so at most one of them
+    per book waits for the worker: a crowd of requests for one popular book
+    queues on the loop instead of in front of requests for other books.
+    Those methods return the changed book as a dict, copied before the
+    next change of the book can start.
+
+    Changes are group committed: the ones that arrive while the previous
+    batch is being written (or within commit_window seconds of the first)
+    run together, up to max_batch of them, with a single write of the files
+    at the end. Each caller gets its answer once its batch is on disk. A
+    LibraryError refuses just its change; any other error rolls the batch
+    back, and its changes are then retried one at a time.
+    """
+    def __init__(self, service, commit_window=0, max_batch=256):
+        self.service = service
+        self.commit_window = commit_window
+        self.max_batch = max_batch
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.book_locks = {}    # book id -> [asyncio.Lock, number of tasks using it]
+        self.pending = []       # (function, args, future) waiting for the next batch
+        self.committer = None   # task writing batches while there are pending changes
+
+    async def run(self, func, *args):
+        """Call a blocking function on the worker thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def commit(self, func, *args):
+        """Call a function that changes the library as part of the next batch"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((func, args, future))
+        if self.committer is None or self.committer.done():
+            self.committer = asyncio.ensure_future(self.write_batches())
+        return await future
+
+    async def write_batches(self):
+        # let the changes arriving right after this one join its batch
+        await asyncio.sleep(self.commit_window)
+        while self.pending:
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            try:
+                results = await self.run(self.apply_batch, batch)
+            except Exception as e:
+                # the batch was rolled back, so rather than fail every change in
+                # it, run them again one by one: only the change that failed (or
+                # every one, if the disk is what fails) gets the error
+                if len(batch) == 1:
+                    results = [(False, e)]
+                else:
+                    results = []
+                    for change in batch:
+                        try:
+                            results += await self.run(self.apply_batch, [change])
+                        except Exception as e:
+                            results.append((False, e))
+            for (func, args, future), (ok, result) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(result)
+
+    @METRICS.timed("group_commit")
+    def apply_batch(self, batch):
+        """Run a batch of changes on the worker, returns (ok, result or error) for each"""
+        METRICS.count("library_group_commits_total")
+        METRICS.count("library_group_commit_changes_total", len(batch))
+        results = []
+        with self.service.batched():
+            for func, args, future in batch:
+                try:
+                    results.append((True, func(*args)))
+                except LibraryError as e:
+                    results.append((False, e))
+        return results
+
+    @contextlib.asynccontextmanager
+    async def book_lock(self, book_id):
+        entry = self.book_locks.get(book_id)
+        if entry is None:
+            entry = self.book_locks[book_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            # drop the lock with its last user, so idle books cost nothing
+            if not entry[1]:
+                del self.book_locks[book_id]
+
+    async def borrow(self, Username, book_id):
+        async with self.book_lock(book_id):
+            book = await self.commit(self.service.borrow, Username, book_id)
+            return book.to_dict()
+
+    async def return_book(self, Username, book_id):
+        async with self.book_lock(book_id):
+            book = await self.commit(self.service.return_book, Username, book_id)
+            return book.to_dict()
+
+    async def change_copies(self, book_id, change):
+        async with self.book_lock(book_id):
+            book = await self.commit(self.service.change_copies, book_id, change)
+            return book.to_dict()
+
+    async def set_copies(self, book_id, available_copies):
+        async with self.book_lock(book_id):
+            book = await self.commit(self.service.set_copies, book_id, available_copies)
+            return book.to_dict()
+
+    async def remove_book(self, book_id):
+        async with self.book_lock(book_id):
+            book = await self.commit(self.service.remove_book, book_id)
+            return book.to_dict()
+
+    async def commit_many(self, book_ids, func, *args):
+        """Commit a bulk change holding the lock of every book it touches, see LibraryService.apply_each"""
+        async with contextlib.AsyncExitStack() as stack:
+            # always taken in id order, so two bulk changes cannot wait on each other
+            for book_id in sorted(set(book_ids)):
+                await stack.enter_async_context(self.book_lock(book_id))
+            outcomes = await self.commit(func, *args)
+            return [outcome.to_dict() if isinstance(outcome, Book) else outcome for outcome in outcomes]
+
+    async def borrow_many(self, Username, book_ids):
+        return await self.commit_many(book_ids, self.service.borrow_many, Username, book_ids)
+
+    async def return_many(self, returns):
+        return await self.commit_many([book_id for _, book_id in returns], self.service.return_many, returns)
+
+    async def change_copies_many(self, changes):
+        return await self.commit_many([book_id for book_id, _ in changes], self.service.change_copies_many, changes)
+
+    async def undo(self, event_id=None):
+        event = await self.run(self.service.undo_target, event_id)
+        async with self.book_lock(event["book_id"]):
+            book = await self.commit(self.service.undo, event["id"])
+            return book.to_dict()
+
+    async def rollback(self, event_id):
+        events = await self.run(self.service.rollback_targets, event_id)
+        return await self.commit_many([event["book_id"] for event in events], self.service.rollback, event_id)
+
+
+# -------------------- HTTP API --------------------
+class LibraryServer:
+    """JSON over HTTP front end for LibraryService
+
+    One asyncio event loop serves every connection; the library calls go
+    through a LibraryEngine so they block its worker thread, not the loop.
+    """
+    ROUTES = [
+        ("GET", r"/books", "list_books"),
+        ("GET", r"/books/(\d+)", "get_book"),
+        ("POST", r"/accounts", "create_account"),
+        ("GET", r"/accounts/([^/]+)", "account_info"),
+        ("POST", r"/accounts/([^/]+)/loans", "borrow"),
+        ("DELETE", r"/accounts/([^/]+)/loans/(\d+)", "return_book"),
+        ("POST", r"/admin/books", "add_book"),
+        ("PATCH", r"/admin/books", "edit_books"),
+        ("PATCH", r"/admin/books/(\d+)", "edit_book"),
+        ("POST", r"/admin/returns", "return_many"),
+        ("DELETE", r"/admin/books/(\d+)", "remove_book"),
+        ("POST", r"/admin/undo", "undo"),
+        ("POST", r"/admin/rollback", "rollback"),
+        ("GET", r"/admin/loans", "all_loans"),
+        ("GET", r"/admin/history", "history"),
+        ("GET", r"/admin/stats", "stats"),
+        ("GET", r"/metrics", "metrics"),
+    ]
+    # first match wins, so subclasses come before LibraryError
+    ERROR_STATUS = [
+        (InvalidInput, 400),
+        (AuthenticationFailed, 401),
+        (NotFound, 404),
+        (LibraryError, 409),
+    ]
+    MAX_BODY = 1 << 20
+
+    def __init__(self, service, host="127.0.0.1", port=8080):
+        self.service = service
+        self.engine = LibraryEngine(service)
+        self.host = host
+        self.port = port
+        self.routes = [(method, re.compile(pattern + "$"), getattr(self, name))
+                       for method, pattern, name in self.ROUTES]
+
+    async def serve(self, sock=None):
+        """Accept connections until cancelled, on sock if given (shared by worker processes)"""
+        if sock is not None:
+            server = await asyncio.start_server(self.handle_client, sock=sock)
+        else:
+            server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+        """Answer requests on one connection until the client closes it"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                    length = int(headers.get("content-length") or 0)
+                    if not 0 <= length <= self.MAX_BODY:
+                        raise ValueError
+                except ValueError:
+                    await self.respond(writer, 400, {"error": "Malformed request"}, False)
+                    break
+                body = await reader.readexactly(length)
+                
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                status, payload = await self.dispatch(method, target, headers, body)
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, payload, keep_alive):
+        """Send payload as json, or as plain text when it is a string"""
+        if isinstance(payload, str):
+            data = payload.encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        writer.write(
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + data)
+        await writer.drain()
+
+    async def dispatch(self, method, target, headers, body):
+        """(status, json payload) for one request"""
+        url = urlsplit(target)
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(url.path)
+            if match and route_method == method:
+                break
+        else:
+            METRICS.count("library_http_requests_total", route="unknown", status=404)
+            return 404, {"error": "No such endpoint"}
+        
+        started = time.perf_counter()
+        status, payload = await self.call(handler, match, url, headers, body)
+        METRICS.observe("http_" + handler.__name__, time.perf_counter() - started)
+        METRICS.count("library_http_requests_total", route=handler.__name__, status=status)
+        return status, payload
+
+    async def call(self, handler, match, url, headers, body):
+        try:
+            data = json.loads(body) if body else {}
+            if not isinstance(data, dict):
+                raise ValueError
+        except ValueError:
+            return 400, {"error": "Request body must be a json object"}
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        # the path is matched still percent-encoded, so an encoded "/" stays inside its segment
+        args = [unquote(group) for group in match.groups()]
+        
+        try:
+            return await handler(*args, query=query, data=data, auth=self.credentials(headers))
+        except LibraryError as e:
+            return self.error_status(e), {"error": str(e)}
+        except (OSError, sqlite3.Error) as e:
+            return 500, {"error": f"Storage error: {e}"}
+        except Exception as e:
+            # answered all the same, a dropped connection tells the client nothing
+            traceback.print_exc()
+            return 500, {"error": f"Internal error: {e}"}
+
+    def error_status(self, error):
+        return next(status for error_type, status in self.ERROR_STATUS if isinstance(error, error_type))
+
+    def outcomes(self, results):
+        """{"results": [...]} for a bulk change: the book, or the error and its status, per item"""
+        return {"results": [{"ok": False, "status": self.error_status(result), "error": str(result)}
+                            if isinstance(result, LibraryError) else {"ok": True, "book": result}
+                            for result in results]}
+
+    @staticmethod
+    def credentials(headers):
+        """(username, password) from a Basic Authorization header, or None"""
+        scheme, _, encoded = headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "basic":
+            return None
+        try:
+            username, _, password = base64.b64decode(encoded).decode("utf-8").partition(":")
+        except ValueError:
+            return None
+        return username, password
+
+    async def require_user(self, Username, auth):
+        if auth is None or auth[0] != Username:
+            raise AuthenticationFailed("Wrong username or password")
+        await self.engine.run(self.service.login, *auth)
+
+    def require_admin(self, auth):
+        self.service.admin_login(*(auth or ("", "")))
+
+    @staticmethod
+    def int_field(data, name):
+        value = data.get(name)
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise InvalidInput(f"'{name}' must be a whole number")
+        if abs(value) > MAX_INT:
+            raise InvalidInput(f"'{name}' is out of range")
+        return value
+
+    @staticmethod
+    def whole_number(text):
+        """int(text), also raising ValueError for numbers too large to store"""
+        value = int(text)
+        if abs(value) > MAX_INT:
+            raise ValueError(f"{text} is out of range")
+        return value
+
+    @classmethod
+    def path_id(cls, text):
+        """A book id from the path, which the route only checks for digits"""
+        try:
+            return cls.whole_number(text)
+        except ValueError:
+            raise InvalidInput("Book id is out of range")
+
+    @staticmethod
+    def list_field(data, name):
+        """A list of json objects, checked before any of them is applied"""
+        items = data.get(name)
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise InvalidInput(f"'{name}' must be a list of objects")
+        return items
+
+    # ---- books ----
+    async def list_books(self, query, data, auth):
+        try:
+            offset = max(self.whole_number(query.get("offset", 0)), 0)
+            limit = min(max(self.whole_number(query.get("limit", 50)), 1), 1000)
+        except ValueError:
+            raise InvalidInput("offset and limit must be whole numbers")
+        try:
+            year_from, year_to = (self.whole_number(query[name]) if query.get(name) else None
+                                  for name in ("year_from", "year_to"))
+        except ValueError:
+            raise InvalidInput("year_from and year_to must be whole numbers")
+        available = query.get("available", "").lower() in ("1", "true", "yes")
+        if query.get("q"):
+            total, page = await self.engine.run(self.service.ranked_search, query["q"], offset, limit)
+        else:
+            total, page = await self.engine.run(self.service.filter_books, available, query.get("author"),
+                                                year_from, year_to, offset, limit)
+        return 200, {"total": total, "offset": offset, "books": [book.to_dict() for book in page]}
+
+    async def get_book(self, book_id, query, data, auth):
+        book = await self.engine.run(self.service.get_book, self.path_id(book_id))
+        return 200, book.to_dict()
+
+    # ---- accounts ----
+    async def create_account(self, query, data, auth):
+        Username, Password = data.get("username"), data.get("password")
+        if not isinstance(Username, str) or not isinstance(Password, str):
+            raise InvalidInput("username and password are required")
+        await self.engine.commit(self.service.create_account, Username.strip(), Password)
+        return 201, {"username": Username.strip()}
+
+    async def account_info(self, Username, query, data, auth):
+        await self.require_user(Username, auth)
+        return 200, {"username": Username, "loans": await self.engine.run(self.service.loans, Username)}
+
+    async def borrow(self, Username, query, data, auth):
+        """Body {"book_id": n} borrows one book, {"book_ids": [...]} several at once"""
+        await self.require_user(Username, auth)
+        if "book_ids" in data:
+            book_ids = data["book_ids"]
+            if not isinstance(book_ids, list) or not all(
+                    isinstance(book_id, int) and not isinstance(book_id, bool) for book_id in book_ids):
+                raise InvalidInput("'book_ids' must be a list of whole numbers")
+            return 200, self.outcomes(await self.engine.borrow_many(Username, book_ids))
+        return 201, await self.engine.borrow(Username, self.int_field(data, "book_id"))
+
+    async def return_book(self, Username, book_id, query, data, auth):
+        await self.require_user(Username, auth)
+        return 200, await self.engine.return_book(Username, self.path_id(book_id))
+
+    # ---- admin ----
+    async def add_book(self, query, data, auth):
+        self.require_admin(auth)
+        book = await self.engine.commit(self.service.add_book, data.get("name"), data.get("author"),
+                                        data.get("year"), data.get("total_copies"))
+        return 201, book.to_dict()
+
+    async def edit_book(self, book_id, query, data, auth):
+        """Body {"change": n} adds or removes copies, {"available_copies": n} sets them"""
+        self.require_admin(auth)
+        if "change" in data:
+            return 200, await self.engine.change_copies(self.path_id(book_id), self.int_field(data, "change"))
+        return 200, await self.engine.set_copies(self.path_id(book_id), self.int_field(data, "available_copies"))
+
+    async def edit_books(self, query, data, auth):
+        """Body {"changes": [{"book_id": n, "change": m}, ...]}, applied with one write"""
+        self.require_admin(auth)
+        changes = [(self.int_field(item, "book_id"), self.int_field(item, "change"))
+                   for item in self.list_field(data, "changes")]
+        return 200, self.outcomes(await self.engine.change_copies_many(changes))
+
+    async def return_many(self, query, data, auth):
+        """Body {"returns": [{"username": "...", "book_id": n}, ...]}, taken back with one write"""
+        self.require_admin(auth)
+        returns = []
+        for item in self.list_field(data, "returns"):
+            if not isinstance(item.get("username"), str):
+                raise InvalidInput("'username' must be a string")
+            returns.append((item["username"], self.int_field(item, "book_id")))
+        return 200, self.outcomes(await self.engine.return_many(returns))
+
+    async def remove_book(self, book_id, query, data, auth):
+        self.require_admin(auth)
+        return 200, await self.engine.remove_book(self.path_id(book_id))
+
+    async def undo(self, query, data, auth):
+        """Body {"id": "..."} undoes that operation, an empty body the latest change"""
+        self.require_admin(auth)
+        event_id = data.get("id")
+        if event_id is not None and not isinstance(event_id, str):
+            raise InvalidInput("'id' must be an operation id from /admin/history")
+        return 200, await self.engine.undo(event_id)
+
+    async def rollback(self, query, data, auth):
+        """Body {"id": "..."}: undo every change made after that operation, with one write"""
+        self.require_admin(auth)
+        if not isinstance(data.get("id"), str):
+            raise InvalidInput("'id' must be an operation id from /admin/history")
+        return 200, self.outcomes(await self.engine.rollback(data["id"]))
+
+    async def all_loans(self, query, data, auth):
+        self.require_admin(auth)
+        return 200, await self.engine.run(self.service.borrowed_books)
+
+    async def history(self, query, data, auth):
+        """Filtered by ?user=, ?book_id=, ?type= (comma separated), ?since= and ?until= (unix times)"""
+        self.require_admin(auth)
+        try:
+            book_id = self.whole_number(query["book_id"]) if query.get("book_id") else None
+            since, until = (float(query[name]) if query.get(name) else None for name in ("since", "until"))
+            limit = min(max(self.whole_number(query.get("limit", 50)), 1), 1000)
+        except ValueError:
+            raise InvalidInput("book_id, since, until and limit must be numbers")
+        types = query["type"].split(",") if query.get("type") else None
+        return 200, await self.engine.run(self.service.history, query.get("user") or None, book_id,
+                                          since, until, types, limit)
+
+    async def stats(self, query, data, auth):
+        self.require_admin(auth)
+        return 200, await self.engine.run(self.service.stats)
+
+    async def metrics(self, query, data, auth):
+        """Prometheus text, or json with ?format=json"""
+        if query.get("format") == "json":
+            return 200, await self.engine.run(self.service.metrics)
+        return 200, await self.engine.run(self.service.metrics_text)
+
+
+def serve_workers(open_service, host, port, workers):
+    """Serve the API from several forked processes accepting on one socket
+
+    Each worker opens its own LibraryService with open_service(), so nothing
+    like a SQLite connection crosses the fork. They share the catalog through
+    the data files or database, whose locks already keep their changes safe.
+    When they stop, their metrics are added to this process's METRICS.
+    """
+    sock = socket.create_server((host, port))
+    # or the children would print what is still buffered too
+    sys.stdout.flush()
+    metrics_dir = tempfile.mkdtemp(prefix="library-metrics.")
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            service = None
+            # the parent's numbers stay with the parent
+            METRICS.reset()
+            try:
+                service = open_service()
+                service.shared = True
+                asyncio.run(LibraryServer(service, host, port).serve(sock))
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                # a second signal, as from pkill or the parent passing one on,
+                # must not cut the history flush short
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                # os._exit skips the atexit hooks, so do their work here
+                try:
+                    if service is not None:
+                        service.library.history.close()
+                    with open(os.path.join(metrics_dir, f"{os.getpid()}.json"), "w", encoding="utf-8") as f:
+                        json.dump(METRICS.state(), f)
+                except BaseException:
+                    traceback.print_exc()
+                os._exit(code)
+        children.append(pid)
+    sock.close()
+    
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    # a plain kill of this process stops the workers too
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            with contextlib.suppress(ChildProcessError):
+                os.waitpid(pid, 0)
+        raise
+    finally:
+        for name in os.listdir(metrics_dir):
+            path = os.path.join(metrics_dir, name)
+            with contextlib.suppress(OSError, ValueError):
+                with open(path, "r", encoding="utf-8") as f:
+                    METRICS.merge(json.load(f))
+            os.unlink(path)
+        os.rmdir(metrics_dir)
+
+
+# -------------------- main --------------------
+def main():
+    parser = argparse.ArgumentParser(description="Library Management System")
+    parser.add_argument("--journal", action="store_true",
+                        help="append changes to .log files instead of rewriting books.json and acount_info.csv")
+    parser.add_argument("--sqlite", metavar="DB",
+                        help="keep books, users and loans in this SQLite database (filled from the json/csv files on first run)")
+    parser.add_argument("--import", dest="import_file", metavar="FILE",
+                        help="add the books in a .txt, .csv, .json or .jsonl file to the catalog and exit")
+    parser.add_argument("--serve", metavar="PORT", type=int,
+                        help="run the JSON/HTTP API on this port instead of the menus")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address the API listens on (default 127.0.0.1)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes serving the API (default 1)")
+    parser.add_argument("--no-metrics", action="store_true",
+                        help="record no timings or counters (same as LIBRARY_METRICS=0)")
+    parser.add_argument("--metrics-file", metavar="FILE",
+                        help="write the metrics of this run to a json file on exit")
+    args = parser.parse_args()
+    if args.workers > 1 and not (args.journal or args.sqlite):
+        # with books.json alone, every change makes the other workers load the whole file again
+        parser.error("--workers needs --journal or --sqlite")
+    if args.no_metrics:
+        METRICS.enabled = False
+
+    storage = SqliteStorage(args.sqlite) if args.sqlite else None
+    library = Library(journal=args.journal, storage=storage)
+    for line_no, error in library.skipped_lines:
+        print(f"❌ Skipping line {line_no} of {library.txtfile}: {error}")
+    
+    if args.import_file:
+        try:
+            report = library.import_books(args.import_file)
+        except (OSError, ValueError) as e:
+            # the batches saved before the error stay imported
+            print(f"❌ Could not import {args.import_file}: {e}")
+            return
+        rate = report["imported"] / report["seconds"] if report["seconds"] else 0
+        print(f"✅ Imported {report['imported']} books in {report['seconds']:.2f}s ({rate:.0f} books/s)")
+        print(f"   {report['duplicates']} duplicates skipped, {report['rejected']} rows rejected")
+        for line_no, error in report["errors"]:
+            print(f"❌ Line {line_no}: {error}")
+        return
+    users = UsersAcount(journal=args.journal, storage=storage)
+    for Username, label in users.migrate_loans(library):
+        print(f"❌ Borrowed book '{label}' of {Username} is not in the library, dropping it")
+    service = LibraryService(library, users)
+    admin = Admin()
+    if args.metrics_file:
+        atexit.register(lambda: atomic_write(args.metrics_file,
+                                             lambda f: json.dump(service.metrics(), f, indent=2)))
+    
+    if args.serve is not None:
+        def open_service():
+            storage = SqliteStorage(args.sqlite) if args.sqlite else None
+            return LibraryService(Library(journal=args.journal, storage=storage),
+                                  UsersAcount(journal=args.journal, storage=storage))
+        
+        workers = args.workers
+        if workers > 1 and not hasattr(os, "fork"):
+            print("❌ Worker processes need os.fork, serving from this process only")
+            workers = 1
+        print(f"📡 Serving the library API on http://{args.host}:{args.serve}"
+              + (f" with {workers} worker processes" if workers > 1 else ""))
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+        # a plain kill stops the server cleanly too, running the exit hooks (--metrics-file)
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            if workers > 1:
+                serve_workers(open_service, args.host, args.serve, workers)
+            else:
+                asyncio.run(LibraryServer(service, args.host, args.serve).serve())
+        except KeyboardInterrupt:
+            print("\n👋 Server stopped")
+        return
 
     print(f"\n{'='*60}")
     print("📚 WELCOME TO LIBRARY MANAGEMENT SYSTEM 📚")
     print(f"{'='*60}")
+    peak = peak_memory_mb()
+    print(f"Loaded {len(library.books)} books in {library.load_seconds:.2f}s"
+          + (f" (peak memory {peak:.0f} MB)" if peak is not None else ""))
     
     while True:
         print(f"\n{'='*50}")
@@ -961,11 +4382,11 @@ def main():
         choice = input("\nEnter your choice: ").strip()
         
         if choice == "1":
-            users.createAcount(library)
+            users.createAcount(service)
         elif choice == "2":
-            users.login(library)
+            users.login(service)
         elif choice == "3":
-            admin.adminLogin(library)
+            admin.adminLogin(service)
         elif choice == "4":
             print(f"\n{'='*50}")
             print("👋 Thank you for using Library Management System!")
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import library
+
+
+@pytest.fixture
+def open_service(tmp_path, monkeypatch):
+    """open_service(mode) opens a LibraryService ("json", "journal" or "sqlite") on files in tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    services = []
+
+    def open_service(mode="json"):
+        storage = library.SqliteStorage("library.db") if mode == "sqlite" else None
+        service = library.LibraryService(library.Library(journal=mode == "journal", storage=storage),
+                                         library.UsersAcount(journal=mode == "journal", storage=storage))
+        services.append(service)
+        return service
+    yield open_service
+    for service in services:
+        service.library.history.close()
@@ -0,0 +1,32 @@
+import asyncio
+
+import pytest
+
+from library import LibraryEngine
+
+
+@pytest.mark.parametrize("mode", ["json", "journal", "sqlite"])
+def test_a_failing_change_fails_alone_in_its_batch(open_service, mode):
+    service = open_service(mode)
+    book = service.add_book("Clean Code", "Robert Martin", 2008, 4)
+    for Username in "abcd":
+        service.create_account(Username, "password1")
+
+    borrow = service.borrow
+    def faulty_borrow(Username, book_id):
+        changed = borrow(Username, book_id)
+        if Username == "c":
+            # after the change was made, so the batch has something to roll back
+            raise RuntimeError("boom")
+        return changed
+
+    async def borrow_all():
+        engine = LibraryEngine(service)
+        return await asyncio.gather(*(engine.commit(faulty_borrow, Username, book["id"]) for Username in "abcd"),
+                                    return_exceptions=True)
+    outcomes = asyncio.run(borrow_all())
+
+    assert [isinstance(outcome, RuntimeError) for outcome in outcomes] == [False, False, True, False]
+    reopened = open_service(mode)
+    assert reopened.get_book(book["id"])["available_copies"] == 1
+    assert sorted(reopened.users.all_loans()) == ["a", "b", "d"]
@@ -0,0 +1,71 @@
+import pytest
+
+from library import Conflict, NotFound
+
+MODES = ["json", "journal", "sqlite"]
+
+
+def copies(service, book_id):
+    return service.get_book(book_id)["available_copies"]
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_undo_redo_and_rollback(open_service, mode):
+    service = open_service(mode)
+    book = service.add_book("Clean Code", "Robert Martin", 2008, 2)
+    added = service.history(types=["add_book"])[0]
+    service.change_copies(book["id"], 3)
+    service.change_copies(book["id"], -1)
+    assert copies(service, book["id"]) == 4
+
+    # undo latest goes back one change at a time
+    service.undo()
+    assert copies(service, book["id"]) == 5
+    service.undo()
+    assert copies(service, book["id"]) == 2
+
+    # undoing an undo redoes its change
+    last_undo = service.history(types=["undo"])[0]
+    service.undo(last_undo["id"])
+    assert copies(service, book["id"]) == 5
+    redo = service.history(types=["undo"])[0]
+    assert redo["redo"] and redo["undoes"] == last_undo["id"]
+    with pytest.raises(Conflict):
+        service.undo(last_undo["id"])
+
+    # back to right after the book was added: only the redo is still in effect
+    targets = service.rollback_targets(added["id"])
+    assert [event["id"] for event in targets] == [redo["id"]]
+    service.rollback(added["id"])
+    assert copies(service, book["id"]) == 2
+    assert service.rollback_targets(added["id"]) == []
+
+    # a reopened service reads the same history back from history.log
+    service.library.history.close()
+    reopened = open_service(mode)
+    assert copies(reopened, book["id"]) == 2
+    assert reopened.rollback_targets(added["id"]) == []
+    reopened.undo(added["id"])
+    with pytest.raises(NotFound):
+        reopened.get_book(book["id"])
+    # undo latest only goes back in time, and there is nothing before the addition
+    with pytest.raises(NotFound):
+        reopened.undo()
+    # undoing that undo brings the book back with its id
+    reopened.undo(reopened.history(types=["undo"])[0]["id"])
+    assert copies(reopened, book["id"]) == 2
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_undo_refuses_what_cannot_be_undone(open_service, mode):
+    service = open_service(mode)
+    with pytest.raises(NotFound):
+        service.undo()
+    service.create_account("alice", "password1")
+    book = service.add_book("Clean Code", "Robert Martin", 2008, 1)
+    service.borrow("alice", book["id"])
+    with pytest.raises(Conflict):
+        service.undo(service.history(types=["borrow"])[0]["id"])
+    # undoing the addition would remove a book on loan
+    with pytest.raises(Conflict):
+        service.undo()
@@ -0,0 +1,51 @@
+import io
+import json
+import random
+
+import pytest
+
+from library import iter_json_array, parse_book_row
+
+# from one character at a time up to the default, so chunks end everywhere
+CHUNK_SIZES = [1, 2, 3, 7, 64, 1 << 20]
+
+MALFORMED = ["[1 2]", "[1,,2]", "[1,]", "[,1]", "[1", "[", "", "x[1]", "[1]x", "[1]  ,", "[1]\n]", "[1,\n]",
+             '[{"a":1},\n,{"b":2}]', '[{"a":1},,\n{"b":2}\n]', '{"a":1}']
+
+WELL_FORMED = ["[]", " [ ] ", "[1]", "[1, 2 ,3]", " " * 5000 + "[1,\n2]\n\n",
+               '[\n    {"a": 1},\n    {"b": [1,\n2]},\n    3.5e2\n]\n',
+               '[12345678901234567890, -1.5e-3, "a,]b", "x\\n\\"y"]']
+
+
+def parse(text, chunk_size):
+    return list(iter_json_array(io.StringIO(text), chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("text", MALFORMED)
+def test_malformed_arrays_are_rejected(text, chunk_size):
+    with pytest.raises(ValueError):
+        parse(text, chunk_size)
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("text", WELL_FORMED)
+def test_arrays_parse_as_json_does(text, chunk_size):
+    assert parse(text, chunk_size) == json.loads(text)
+
+
+@pytest.mark.parametrize("chunk_size", [5, 100, 4096])
+def test_books_json_across_chunk_boundaries(chunk_size):
+    rng = random.Random(1)
+    books = [{"id": i, "name": "n" * rng.randint(0, 40), "tags": [1, {"note": "a\nb"}]} for i in range(500)]
+    # laid out as save_books writes it, one book per line
+    text = "[\n" + ",\n".join("    " + json.dumps(book) for book in books) + "\n]\n"
+    assert parse(text, chunk_size) == books
+
+
+def test_parse_book_row_checks_ranges():
+    assert parse_book_row(["Clean Code", "Robert Martin", "2008", "3"])["available_copies"] == 3
+    for row in (["Clean Code", "Robert Martin", 2008, -1], ["Clean Code", "Robert Martin", 10 ** 23, 1],
+                ["Clean Code", "Robert Martin", 2008, 10 ** 23], ["Clean Code", "Robert Martin", 2008, 2, 3]):
+        with pytest.raises(ValueError):
+            parse_book_row(row)
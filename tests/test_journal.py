@@ -0,0 +1,88 @@
+import json
+
+from library import Journal
+
+
+def test_replay_returns_appended_records(tmp_path):
+    journal = Journal(str(tmp_path / "books.json.log"))
+    journal.append({"op": "put", "book": {"id": 1}})
+    journal.append({"op": "del", "id": 1}, {"op": "put", "book": {"id": 2}})
+
+    reader = Journal(journal.filepath)
+    assert reader.replay() == [{"op": "put", "book": {"id": 1}}, {"op": "del", "id": 1},
+                               {"op": "put", "book": {"id": 2}}]
+    assert reader.pending == 3
+    assert reader.offset == (tmp_path / "books.json.log").stat().st_size
+    # from the offset reached, only what was appended since
+    journal.append({"op": "del", "id": 2})
+    assert reader.replay(reader.offset) == [{"op": "del", "id": 2}]
+    assert reader.pending == 4
+
+
+def test_replay_stops_at_a_torn_last_line(tmp_path):
+    path = tmp_path / "books.json.log"
+    path.write_text('{"op":"del","id":1}\n{"op":"del","id":2}\n{"op":"put","bo', encoding="utf-8")
+    journal = Journal(str(path))
+
+    assert journal.replay() == [{"op": "del", "id": 1}, {"op": "del", "id": 2}]
+    assert journal.offset == len('{"op":"del","id":1}\n{"op":"del","id":2}\n')
+    # the next append drops the torn record instead of gluing itself to it
+    journal.append({"op": "del", "id": 3})
+    assert [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()] == [
+        {"op": "del", "id": 1}, {"op": "del", "id": 2}, {"op": "del", "id": 3}]
+
+
+def test_replay_stops_at_a_line_that_is_not_json(tmp_path):
+    path = tmp_path / "books.json.log"
+    path.write_text('{"op":"del","id":1}\nnot json\n{"op":"del","id":2}\n', encoding="utf-8")
+    assert Journal(str(path)).replay() == [{"op": "del", "id": 1}]
+
+
+def test_append_reports_when_compaction_is_due(tmp_path):
+    journal = Journal(str(tmp_path / "books.json.log"), compact_every=3)
+    assert not journal.append({"op": "del", "id": 1})
+    assert journal.append({"op": "del", "id": 2}, {"op": "del", "id": 3})
+    journal.reset()
+    assert journal.pending == 0
+    assert (tmp_path / "books.json.log").read_text(encoding="utf-8") == ""
+
+
+def catalog(service):
+    return sorted((book["id"], book["name"], book["available_copies"]) for book in service.library.books)
+
+
+def test_library_replays_its_journal(open_service):
+    service = open_service("journal")
+    first = service.add_book("Clean Code", "Robert Martin", 2008, 2)
+    second = service.add_book("Blindness", "Jose Saramago", 1995, 1)
+    service.change_copies(first["id"], 3)
+    service.remove_book(second["id"])
+
+    # books.json was never rewritten, the reopened library has only the journal to go by
+    assert json.load(open("books.json", encoding="utf-8")) == []
+    assert catalog(open_service("journal")) == [(first["id"], "Clean Code", 5)]
+
+
+def test_compaction_folds_the_journal_into_books_json(open_service):
+    service = open_service("journal")
+    book = service.add_book("Clean Code", "Robert Martin", 2008, 2)
+    service.change_copies(book["id"], -1)
+    service.library.compact()
+
+    assert open("books.json.log", encoding="utf-8").read() == ""
+    assert [(saved["id"], saved["available_copies"]) for saved in json.load(open("books.json", encoding="utf-8"))] \
+        == [(book["id"], 1)]
+    assert catalog(open_service("journal")) == [(book["id"], "Clean Code", 1)]
+
+
+def test_library_ignores_a_torn_journal_record(open_service):
+    service = open_service("journal")
+    book = service.add_book("Clean Code", "Robert Martin", 2008, 2)
+    with open("books.json.log", "a", encoding="utf-8") as f:
+        f.write('{"op":"put","book":{"id":99,"name":"Half wri')
+
+    reopened = open_service("journal")
+    assert catalog(reopened) == [(book["id"], "Clean Code", 2)]
+    # a change after the crash is kept, the torn record is not
+    reopened.change_copies(book["id"], 1)
+    assert catalog(open_service("journal")) == [(book["id"], "Clean Code", 3)]